@@ -0,0 +1,406 @@
+"""
+Load test of the trivia endpoints
+
+Seeds a synthetic question bank, then sends requests to GET /questions,
+POST /questions/search, GET /categories/<id>/questions and POST /quizzes
+(players whose previous_questions grow with every round) through the flask
+test client and through a real HTTP server. Prints p50/p99 latencies and
+requests per second of every endpoint as JSON: save the output of two
+commits and diff them, or pass --baseline to add the ratios to a saved run.
+
+Without DATABASE_URL a temporary sqlite database is used. Given one, the
+synthetic questions are added to it and deleted at the end. The rate
+limits are off unless --config RATE_LIMITS=... sets them, the load comes
+from a single client.
+
+From the backend directory:
+
+    python -m benchmarks.load [DATABASE_URL] [--questions N]
+        [--requests N] [--concurrency N] [--driver client|http|both]
+        [--config NAME=VALUE ...] [--baseline FILE] [--output FILE]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr import create_app, QUESTIONS_PER_PAGE
+from flaskr.bulk import import_questions
+from flaskr.ratelimit import DEFAULT_LIMITS
+from models import (
+    db, bump_data_version, recount_questions, Category, Question,
+)
+
+CATEGORY_PREFIX = "Load test "
+
+# words of the synthetic questions, searched for by the search scenario
+WORDS = (
+    "planet", "river", "painter", "element", "battle", "composer",
+    "mountain", "novel", "album", "formula", "emperor", "island",
+)
+
+
+def question_lines(count, categories, rng):
+    for i in range(count):
+        first, second, third = rng.sample(WORDS, 3)
+        yield json.dumps({
+            "question": f"Which {first} is linked to the {second} {i}?",
+            "answer": f"The {third} {i}",
+            "category": categories[i % len(categories)],
+            "difficulty": rng.randint(1, 5),
+        })
+
+
+def seed(count, category_count, rng):
+    """
+    adds `category_count` categories and `count` questions spread over
+    them, returns the category ids
+    """
+    categories = [
+        Category(type=f"{CATEGORY_PREFIX}{i}")
+        for i in range(1, category_count + 1)
+    ]
+    db.session.add_all(categories)
+    db.session.commit()
+    ids = [category.id for category in categories]
+    import_questions(question_lines(count, ids, rng))
+    return ids
+
+
+def clean_up(categories):
+    questions = Question.__table__
+    db.session.execute(
+        questions.delete().where(questions.c.category.in_(categories))
+    )
+    db.session.execute(
+        Category.__table__.delete().where(Category.id.in_(categories))
+    )
+    connection = db.session.connection()
+    recount_questions(connection)
+    bump_data_version(connection)
+    db.session.commit()
+
+
+"""
+Scenarios
+
+A scenario makes the requests of one simulated client: it is called with a
+`send(method, path, body)` function returning (status, decoded JSON body)
+and sends `count` requests.
+"""
+
+
+def questions_scenario(send, count, rng, bank):
+    for _ in range(count):
+        page = rng.randint(1, bank["pages"])
+        send("GET", f"/questions?page={page}", None)
+
+
+def search_scenario(send, count, rng, bank):
+    # whole words, prefixes and two words, from many to few matches
+    terms = list(WORDS) + [word[:3] for word in WORDS] + [
+        f"{first} {second}" for first, second in zip(WORDS, WORDS[1:])
+    ]
+    for _ in range(count):
+        send("POST", "/questions/search", {"searchTerm": rng.choice(terms)})
+
+
+def category_scenario(send, count, rng, bank):
+    for _ in range(count):
+        category = rng.choice(bank["categories"])
+        page = rng.randint(1, bank["category_pages"])
+        send("GET", f"/categories/{category}/questions?page={page}", None)
+
+
+def quiz_scenario(send, count, rng, bank):
+    # a player sends every question asked so far, starting over once the
+    # quiz is over or quiz_length questions were asked
+    previous_questions = []
+    category = rng.choice(bank["categories"])
+    for _ in range(count):
+        _, body = send("POST", "/quizzes", {
+            "previous_questions": previous_questions,
+            "quiz_category": {"id": category},
+        })
+        question = (body or {}).get("question")
+        quiz_over = len(previous_questions) >= bank["quiz_length"]
+        if question is None or quiz_over:
+            previous_questions = []
+            category = rng.choice(bank["categories"])
+        else:
+            previous_questions.append(question["id"])
+
+
+SCENARIOS = {
+    "GET /questions": questions_scenario,
+    "POST /questions/search": search_scenario,
+    "GET /categories/<id>/questions": category_scenario,
+    "POST /quizzes": quiz_scenario,
+}
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def timed(self, send):
+        def timed_send(method, path, body):
+            start = time.perf_counter()
+            status, data = send(method, path, body)
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.latencies.append(elapsed)
+                if status >= 400:
+                    self.errors += 1
+            return status, data
+
+        return timed_send
+
+    def summary(self, wall_time):
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            return round(latencies[min(len(latencies) - 1,
+                                       int(q * len(latencies)))] * 1000, 3)
+
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "p50_ms": percentile(0.50),
+            "p99_ms": percentile(0.99),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "requests_per_second": round(len(latencies) / wall_time, 1),
+        }
+
+
+"""
+Drivers
+"""
+
+
+def client_send(app):
+    client = app.test_client()
+
+    def send(method, path, body):
+        response = client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+    return send
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def http_send(host, port):
+    # one keep-alive connection per client thread
+    local = threading.local()
+
+    def send(method, path, body):
+        connection = getattr(local, "connection", None)
+        if connection is None:
+            connection = local.connection = \
+                http.client.HTTPConnection(host, port)
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        connection.request(method, path, payload, headers)
+        response = connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            connection.close()
+            local.connection = None
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+    return send
+
+
+def split(requests, clients):
+    share, extra = divmod(requests, clients)
+    return [share + (1 if i < extra else 0) for i in range(clients)]
+
+
+def run_client(app, scenario, requests, bank, seed_value):
+    recorder = Recorder()
+    send = recorder.timed(client_send(app))
+    start = time.perf_counter()
+    scenario(send, requests, random.Random(seed_value), bank)
+    return recorder.summary(time.perf_counter() - start)
+
+
+def run_http(port, scenario, requests, concurrency, bank, seed_value):
+    recorder = Recorder()
+    send = recorder.timed(http_send("127.0.0.1", port))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = [
+            executor.submit(scenario, send, count,
+                            random.Random(seed_value + i), bank)
+            for i, count in enumerate(split(requests, concurrency))
+        ]
+        for future in futures:
+            future.result()
+    return recorder.summary(time.perf_counter() - start)
+
+
+def compare(results, baseline):
+    """
+    returns new / baseline of every number of the scenarios of both runs
+    """
+    ratios = {}
+    for driver, scenarios in results["drivers"].items():
+        for name, numbers in scenarios.items():
+            old = baseline.get("drivers", {}).get(driver, {}).get(name)
+            if not old:
+                continue
+            ratios.setdefault(driver, {})[name] = {
+                key: round(value / old[key], 3)
+                for key, value in numbers.items()
+                if key.endswith(("_ms", "_second")) and old.get(key)
+            }
+    return ratios
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def config_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("database_url", nargs="?")
+    parser.add_argument("--questions", type=int, default=10000,
+                        help="synthetic questions, 1000 to 1000000")
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="requests per endpoint and driver")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="client threads of the http driver")
+    parser.add_argument("--quiz-length", type=int, default=20)
+    parser.add_argument("--driver", choices=("client", "http", "both"),
+                        default="both")
+    parser.add_argument("--config", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="app setting, e.g. SNAPSHOT_MODE=true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="JSON output of a previous run")
+    parser.add_argument("--output", help="write the JSON there too")
+    args = parser.parse_args()
+
+    directory = None
+    database_url = args.database_url
+    if database_url is None:
+        directory = tempfile.mkdtemp()
+        database_url = f"sqlite:///{os.path.join(directory, 'load.db')}"
+
+    config = {
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "RATE_LIMITS": dict.fromkeys(DEFAULT_LIMITS),
+    }
+    for setting in args.config:
+        name, _, value = setting.partition("=")
+        config[name] = config_value(value)
+
+    rng = random.Random(args.seed)
+    # the bank is seeded before the app whose caches are measured starts
+    seed_app = create_app({"SQLALCHEMY_DATABASE_URI": database_url})
+    with seed_app.app_context():
+        categories = seed(args.questions, args.categories, rng)
+
+    try:
+        app = create_app(config)
+        bank = {
+            "categories": categories,
+            "pages": max(1, args.questions // QUESTIONS_PER_PAGE),
+            "category_pages": max(
+                1, args.questions // args.categories // QUESTIONS_PER_PAGE
+            ),
+            "quiz_length": args.quiz_length,
+        }
+
+        drivers = {}
+        if args.driver in ("client", "both"):
+            drivers["client"] = {
+                name: run_client(app, scenario, args.requests, bank,
+                                 args.seed)
+                for name, scenario in SCENARIOS.items()
+            }
+        if args.driver in ("http", "both"):
+            server = make_server("127.0.0.1", 0, app, threaded=True,
+                                 request_handler=QuietRequestHandler)
+            thread = threading.Thread(target=server.serve_forever,
+                                      daemon=True)
+            thread.start()
+            try:
+                drivers["http"] = {
+                    name: run_http(server.server_port, scenario,
+                                   args.requests, args.concurrency, bank,
+                                   args.seed)
+                    for name, scenario in SCENARIOS.items()
+                }
+            finally:
+                server.shutdown()
+    finally:
+        with seed_app.app_context():
+            if directory is None:
+                clean_up(categories)
+            db.session.remove()
+            db.get_engine(seed_app).dispose()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": database_url.split(":", 1)[0],
+        "questions": args.questions,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "config": {k: v for k, v in config.items()
+                   if k != "SQLALCHEMY_DATABASE_URI"},
+        "drivers": drivers,
+    }
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            results["baseline_ratios"] = compare(results, json.load(baseline))
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as target:
+            target.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Query plans before and after the indexes of models.py
+
+Prints the plan the database picks for the queries behind the API, first
+without the indexes and then with them. Everything, including the
+synthetic questions used to make the tables big enough for the planner to
+care, happens in a transaction which is rolled back. The only lasting
+change is the schema upgrade the app would run on start anyway.
+
+Without DATABASE_URL a temporary sqlite database is used. Given a postgres
+database, the transaction holds an exclusive lock on the questions table
+until it ends, do not point it at a database in use.
+
+From the backend directory:
+
+    python -m benchmarks.query_plans [DATABASE_URL] [--questions N]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+
+from sqlalchemy import create_engine, text
+
+import models
+from migrations import upgrade
+
+QUERIES = {
+    "GET /categories": (
+        "SELECT id, type FROM categories ORDER BY type"
+    ),
+    "GET /categories/<id>/questions (count)": (
+        "SELECT count(*) FROM questions WHERE category = :category"
+    ),
+    "GET /categories/<id>/questions (page)": (
+        "SELECT * FROM questions WHERE category = :category "
+        "ORDER BY id LIMIT 10 OFFSET 10"
+    ),
+    "GET /categories/<id>/questions?after_id=": (
+        "SELECT * FROM questions WHERE category = :category AND id > :after "
+        "ORDER BY id LIMIT 11"
+    ),
+    "POST /quizzes (category and difficulty)": (
+        "SELECT id FROM questions "
+        "WHERE category = :category AND difficulty = :difficulty"
+    ),
+}
+
+PARAMETERS = {"category": 1, "difficulty": 3, "after": 1000}
+
+
+def explain(connection, sql):
+    if connection.dialect.name == "sqlite":
+        rows = connection.execute(text("EXPLAIN QUERY PLAN " + sql),
+                                  PARAMETERS)
+        return [row[-1] for row in rows]
+    rows = connection.execute(text("EXPLAIN " + sql), PARAMETERS)
+    return [row[0] for row in rows]
+
+
+def seed(connection, count):
+    categories = [
+        row[0] for row in connection.execute(text("SELECT id FROM categories"))
+    ]
+    if not categories:
+        connection.execute(models.Category.__table__.insert(), [
+            {"type": f"Category {i}"} for i in range(1, 7)
+        ])
+        categories = [
+            row[0]
+            for row in connection.execute(text("SELECT id FROM categories"))
+        ]
+
+    rng = random.Random(0)
+    rows = [
+        {
+            "question": f"Synthetic question {i}",
+            "answer": f"Answer {i}",
+            "category": rng.choice(categories),
+            "difficulty": rng.randint(1, 5),
+        }
+        for i in range(count)
+    ]
+    for start in range(0, count, 10000):
+        connection.execute(models.Question.__table__.insert(),
+                           rows[start:start + 10000])
+
+
+def print_plans(connection, title):
+    print(f"== {title}")
+    for name, sql in QUERIES.items():
+        print(f"-- {name}")
+        for line in explain(connection, sql):
+            print(f"   {line}")
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("database_url", nargs="?")
+    parser.add_argument("--questions", type=int, default=100000,
+                        help="synthetic questions to add (default 100000)")
+    args = parser.parse_args()
+
+    directory = None
+    database_url = args.database_url
+    if database_url is None:
+        directory = tempfile.mkdtemp()
+        database_url = f"sqlite:///{os.path.join(directory, 'plans.db')}"
+
+    try:
+        explain_indexes(create_engine(database_url), args.questions)
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+def explain_indexes(engine, questions):
+    upgrade(engine, models.db.metadata)
+
+    indexes = [
+        index
+        for table in models.db.metadata.sorted_tables
+        for index in table.indexes
+    ]
+
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        seed(connection, questions)
+
+        for index in indexes:
+            index.drop(connection, checkfirst=True)
+        connection.execute(text("ANALYZE"))
+        print_plans(connection, "before: without indexes")
+
+        for index in indexes:
+            index.create(connection)
+        connection.execute(text("ANALYZE"))
+        print_plans(connection, "after: with indexes")
+    finally:
+        transaction.rollback()
+        connection.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
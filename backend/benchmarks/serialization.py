@@ -0,0 +1,100 @@
+"""
+ORM objects + format() + jsonify against column tuples + json_response
+
+Times building the body of a page of questions both ways. The synthetic
+questions are added in a transaction which is rolled back at the end. By
+default everything runs on an in-memory sqlite database, pass a database
+url to measure against postgres.
+
+From the backend directory:
+
+    python -m benchmarks.serialization [DATABASE_URL] [--rows N]
+        [--questions N] [--repeat N] [--encoder json|orjson]
+"""
+
+import argparse
+import json
+import time
+
+from flask import jsonify
+
+from flaskr import create_app
+from flaskr.serialization import format_rows, json_response, question_query
+from models import db, Category, Question
+
+
+def seed(count):
+    db.session.execute(Category.__table__.insert(), [{"type": "Synthetic"}])
+    category = db.session.query(Category.id).first()[0]
+    db.session.execute(Question.__table__.insert(), [
+        {
+            "question": f"Synthetic question number {i}?",
+            "answer": f"Answer {i}",
+            "category": category,
+            "difficulty": i % 5 + 1,
+        }
+        for i in range(count)
+    ])
+
+
+def orm_body(rows):
+    questions = Question.query.order_by(Question.id).limit(rows).all()
+    return jsonify({"questions": [q.format() for q in questions]}).data
+
+
+def tuple_body(rows):
+    questions = question_query().order_by(Question.id).limit(rows).all()
+    return json_response({"questions": format_rows(questions)}).data
+
+
+def measure(function, rows, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(rows)
+        timings.append(time.perf_counter() - start)
+        # do not let the identity map keep the objects of the last run
+        db.session.expunge_all()
+    timings.sort()
+    return {
+        "best_ms": round(timings[0] * 1000, 3),
+        "median_ms": round(timings[len(timings) // 2] * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("database_url", nargs="?", default="sqlite://")
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--rows", type=int, default=1000,
+                        help="questions per response (default 1000)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--encoder", default="json")
+    args = parser.parse_args()
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": args.database_url,
+        "JSON_ENCODER": args.encoder,
+    })
+    with app.test_request_context():
+        try:
+            seed(args.questions)
+            if orm_body(args.rows) != tuple_body(args.rows) and \
+                    args.encoder == "json":
+                raise SystemExit("the two bodies differ")
+            results = {
+                "rows": args.rows,
+                "encoder": args.encoder,
+                "orm_format_jsonify": measure(orm_body, args.rows,
+                                              args.repeat),
+                "tuples_json_response": measure(tuple_body, args.rows,
+                                                args.repeat),
+            }
+        finally:
+            db.session.rollback()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Startup time of a worker
+
+Starts fresh processes which import the app, call create_app and send the
+first requests a worker gets (GET /categories, GET /questions,
+POST /questions/search, POST /quizzes) twice. Prints, per startup setting,
+the median milliseconds of the import, of create_app, of the first round
+of requests, of the second round and the time until the worker served
+its first round (ready_ms), as JSON.
+
+The settings compared are the defaults, DB_SCHEMA_CHECK=skip, a lazy
+start (no schema check and no quiz index preload, nothing connects before
+the first request) and WARMUP. Without DATABASE_URL a temporary sqlite
+database with synthetic questions is used, given one the synthetic
+questions are deleted at the end. The rate limits are off, as in
+benchmarks.load.
+
+From the backend directory:
+
+    python -m benchmarks.startup [DATABASE_URL] [--questions N] [--runs N]
+        [--config NAME=VALUE ...] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SETTINGS = {
+    "default": {},
+    "schema check skipped": {"DB_SCHEMA_CHECK": "skip"},
+    "lazy": {"DB_SCHEMA_CHECK": "skip", "QUIZ_INDEX_PRELOAD": False},
+    "warmup": {"WARMUP": True},
+}
+
+FIRST_REQUESTS = (
+    ("GET", "/categories", None),
+    ("GET", "/questions", None),
+    ("POST", "/questions/search", {"searchTerm": "planet"}),
+    ("POST", "/quizzes", {"previous_questions": []}),
+)
+
+
+def start_worker(config):
+    """
+    runs in the child process, returns its timings in milliseconds
+    """
+    start = time.perf_counter()
+    from flaskr import create_app
+    imported = time.perf_counter()
+    app = create_app(config)
+    created = time.perf_counter()
+
+    client = app.test_client()
+    rounds = []
+    for _ in range(2):
+        round_start = time.perf_counter()
+        for method, path, body in FIRST_REQUESTS:
+            response = client.open(path, method=method, json=body)
+            if response.status_code >= 400:
+                raise RuntimeError(
+                    f"{method} {path}: {response.status_code}"
+                )
+        rounds.append(time.perf_counter() - round_start)
+
+    return {
+        "import_ms": (imported - start) * 1000,
+        "create_app_ms": (created - imported) * 1000,
+        "first_requests_ms": rounds[0] * 1000,
+        "next_requests_ms": rounds[1] * 1000,
+        "ready_ms": (created - start + rounds[0]) * 1000,
+    }
+
+
+def run_worker(config):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--worker",
+         json.dumps(config)],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def median_timings(runs):
+    return {
+        key: round(statistics.median(run[key] for run in runs), 3)
+        for key in runs[0]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("database_url", nargs="?")
+    parser.add_argument("--questions", type=int, default=10000)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--runs", type=int, default=5,
+                        help="processes started per setting")
+    parser.add_argument("--config", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="app setting added to every run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON there too")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(start_worker(json.loads(args.worker))))
+        return
+
+    directory = None
+    database_url = args.database_url
+    if database_url is None:
+        directory = tempfile.mkdtemp()
+        database_url = f"sqlite:///{os.path.join(directory, 'startup.db')}"
+
+    # imported here, the worker processes time the import of the app
+    from flaskr import create_app
+    from flaskr.ratelimit import DEFAULT_LIMITS
+    from models import db
+    from .load import clean_up, git_commit, seed
+
+    config = {
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "RATE_LIMITS": dict.fromkeys(DEFAULT_LIMITS),
+    }
+    for setting in args.config:
+        name, _, value = setting.partition("=")
+        try:
+            config[name] = json.loads(value)
+        except ValueError:
+            config[name] = value
+
+    seed_app = create_app({"SQLALCHEMY_DATABASE_URI": database_url})
+    with seed_app.app_context():
+        categories = seed(args.questions, args.categories,
+                          random.Random(args.seed))
+
+    try:
+        settings = {
+            name: median_timings([
+                run_worker(dict(config, **setting))
+                for _ in range(args.runs)
+            ])
+            for name, setting in SETTINGS.items()
+        }
+    finally:
+        with seed_app.app_context():
+            if directory is None:
+                clean_up(categories)
+            db.session.remove()
+            db.get_engine(seed_app).dispose()
+        if directory is not None:
+            shutil.rmtree(directory)
+
+    results = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "database": database_url.split(":", 1)[0],
+        "questions": args.questions,
+        "runs": args.runs,
+        "config": {k: v for k, v in config.items()
+                   if k != "SQLALCHEMY_DATABASE_URI"},
+        "settings": settings,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as target:
+            target.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,66 @@
-import random
 from http import HTTPStatus
 
-from flask import Flask, jsonify, request, abort
+from flask import Flask, jsonify, request, abort, stream_with_context
 from flask_cors import CORS
-
-from models import setup_db, Question, Category
+from sqlalchemy.exc import IntegrityError
+
+from models import db, setup_db, replica_reads, Question, Category
+from . import (
+    bulk, caching, categories, compression, metrics, quiz, ratelimit,
+    search, serialization, sessions, snapshot, startup, stats, writes,
+)
+from .pagination import (
+    decode_cursor, encode_cursor, paginate_request, stream_rows,
+)
+from .serialization import format_rows, json_response, question_query
 
 QUESTIONS_PER_PAGE = 10
+# most questions POST /quizzes returns at once
+DEFAULT_MAX_QUIZ_COUNT = 50
+
+
+def int_field(value):
+    """
+    returns the JSON value `value` as an int if it is one or a string of
+    digits (the frontend form sends strings), None otherwise
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return int(value)
+    return None
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
+    # DATABASE_SEED fills an empty (e.g. in-memory) database
+    bulk.seed(app)
+    # first, so the timings include the hooks of the other extensions
+    request_metrics = metrics.init_app(app)
+    ratelimit.init_app(app)
+    category_registry = categories.init_app(app)
+    question_index = quiz.init_app(app)
+    quiz_sessions = sessions.init_app(app)
+    search_backend = search.init_app(app)
+    question_stats = stats.init_app(app)
+    bulk.init_app(app)
+    serialization.init_app(app)
+    compression.init_app(app)
+    # None unless SNAPSHOT_MODE is on, then reads are served from memory
+    question_snapshot = snapshot.init_app(app)
+    # None unless WRITE_BATCHING is on, then question writes are committed
+    # in groups by a background thread
+    write_queue = writes.init_app(app)
+    # last, with WARMUP it loads the caches created above
+    startup.init_app(app)
+    fetch_question = question_snapshot.get if question_snapshot else None
+    fetch_questions = question_snapshot.get_many if question_snapshot \
+        else None
+    max_quiz_count = app.config.get("QUIZ_MAX_COUNT", DEFAULT_MAX_QUIZ_COUNT)
 
     """
     Set up CORS. Allow '*' for origins. Delete the
@@ -40,15 +88,16 @@ def create_app(test_config=None):
     """
 
     @app.route("/categories")
+    @replica_reads
+    @caching.conditional
     def get_all_categories():
-        categories_db = Category.query.order_by(Category.type).all()
-
-        categories_dict = {}
-        for c in categories_db:
-            category_id, category_type = c.id, c.type
-            categories_dict[category_id] = category_type
-
-        return jsonify({"categories": categories_dict}), HTTPStatus.OK
+        # the serialized body is cached, see categories.py
+        data_version, _ = caching.current_version()
+        return app.response_class(
+            category_registry.json_body(data_version),
+            status=HTTPStatus.OK,
+            mimetype="application/json",
+        )
 
     """
     Create an endpoint to handle GET requests for questions,
@@ -64,40 +113,38 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions", methods=["GET"])
+    @replica_reads
+    @caching.conditional
     def get_all_questions():
-        # pagination start and finish
-        page = int(request.args.get("page", default="1"))
-        start_index = (page - 1) * QUESTIONS_PER_PAGE
-        finish_index = start_index + QUESTIONS_PER_PAGE
-
-        # get all questions from db
-        questions_db = Question.query.all()
-        total_questions = len(questions_db)
-
-        # if page requested is out of range -> return 404 not found
-        if start_index >= total_questions:
-            abort(HTTPStatus.NOT_FOUND)
-
-        # drop question not in current page
-        questions_db = questions_db[start_index:finish_index]
-        questions = [q.format() for q in questions_db]
-
-        # get categories from db, format them in key-value pairs for frontend
-        categories_db = Category.query.order_by(Category.type).all()
+        # pagination is done in the db, only the current page is fetched
+        # ?after_id= uses keyset pagination which stays cheap on deep pages
+        # both abort with 404 if the page requested is out of range
+        data_version, _ = caching.current_version()
+        if question_snapshot is not None:
+            questions_db, total_questions, extra = \
+                question_snapshot.paginate_request(None, QUESTIONS_PER_PAGE)
+            questions = [q.format() for q in questions_db]
+        else:
+            # only the question columns, as tuples, the total comes from
+            # the question counts
+            rows, total_questions, extra = paginate_request(
+                question_query(), Question.id, QUESTIONS_PER_PAGE,
+                total=question_stats.total(data_version),
+            )
+            questions = format_rows(rows)
 
-        categories_dict = {}
-        for c in categories_db:
-            category_id, category_type = c.id, c.type
-            categories_dict[category_id] = category_type
+        # categories in key-value pairs for frontend, served from the cache
+        categories_dict = category_registry.categories(data_version)
 
         result = {
             "questions": questions,
             "total_questions": total_questions,
             "categories": categories_dict,
             "current_category": None,
+            **extra,
         }
 
-        return jsonify(result), HTTPStatus.OK
+        return json_response(result)
 
     """
     Create an endpoint to DELETE question using a question ID.
@@ -108,9 +155,14 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions/<int:key>", methods=["DELETE"])
+    @ratelimit.limited
     def delete_question(key: int):
         question = Question.query.get_or_404(key)
-        question.delete()
+        if write_queue is None:
+            question.delete()
+        elif not write_queue.delete(question.id):
+            # deleted by another request in the meantime
+            abort(HTTPStatus.NOT_FOUND)
         return jsonify(success=True), HTTPStatus.OK
 
     """
@@ -124,6 +176,7 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions", methods=["POST"])
+    @ratelimit.limited
     def post_new_question():
         json = request.get_json()
 
@@ -141,6 +194,12 @@ def create_app(test_config=None):
         ):
             abort(HTTPStatus.BAD_REQUEST)
 
+        # the in-memory indexes are keyed by the int values stored in the db
+        category = int_field(category)
+        difficulty = int_field(difficulty)
+        if category is None or difficulty is None:
+            abort(HTTPStatus.BAD_REQUEST)
+
         # create new question and add commit to the db
         question = Question(
             question=question_text,
@@ -148,43 +207,129 @@ def create_app(test_config=None):
             category=category,
             difficulty=difficulty,
         )
-        question.insert()
+        try:
+            if write_queue is None:
+                question.insert()
+            else:
+                # rolled back by the queue's worker already
+                write_queue.insert(question)
+        except IntegrityError:
+            # e.g. a category which does not exist
+            db.session.rollback()
+            abort(HTTPStatus.UNPROCESSABLE_ENTITY)
 
         return jsonify(success=True), HTTPStatus.OK
 
+    """
+    Bulk import and export of questions as JSON Lines,
+    one question per line with the same attributes as POST /questions.
+    The import is a single transaction, chunk_size rows are inserted
+    per statement.
+    """
+
+    @app.route("/questions/bulk", methods=["POST"])
+    @ratelimit.limited
+    def post_questions_bulk():
+        chunk_size = request.args.get(
+            "chunk_size",
+            default=app.config.get("BULK_CHUNK_SIZE", bulk.DEFAULT_CHUNK_SIZE),
+            type=int,
+        )
+        if chunk_size < 1:
+            abort(HTTPStatus.BAD_REQUEST)
+
+        try:
+            inserted = bulk.import_questions(request.stream, chunk_size)
+        except bulk.BulkImportError as error:
+            # tell the client which line is wrong
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "error": HTTPStatus.UNPROCESSABLE_ENTITY,
+                        "message": HTTPStatus.UNPROCESSABLE_ENTITY.phrase,
+                        "line": error.line,
+                        "reason": error.reason,
+                    }
+                ),
+                HTTPStatus.UNPROCESSABLE_ENTITY,
+            )
+        except IntegrityError:
+            # e.g. a category which does not exist
+            abort(HTTPStatus.UNPROCESSABLE_ENTITY)
+
+        return jsonify(success=True, inserted=inserted), HTTPStatus.OK
+
+    @app.route("/questions/export", methods=["GET"])
+    @replica_reads
+    def get_questions_export():
+        return app.response_class(
+            stream_with_context(bulk.export_questions()),
+            status=HTTPStatus.OK,
+            mimetype="application/x-ndjson",
+        )
+
     """
     Create a POST endpoint to get questions based on a search term.
-    It should return any questions for whom the search term
-    is a substring of the question.
+    It returns the questions whose question or answer has a word starting
+    with every word of the search term, ranked by the search backend (see
+    search.py). Unlike the original substring match, a term matching only
+    the middle of a word ("itle" in "title") finds nothing, which is what
+    lets the search use an index instead of scanning every question.
 
     TEST: Search by any phrase. The questions list will update to include
-    only question that include that string within their question.
+    only questions with words starting with the words of that phrase.
     Try using the word "title" to start.
     """
 
     @app.route("/questions/search", methods=["POST"])
+    @ratelimit.limited
+    @replica_reads
     def search_questions():
         json = request.get_json()
 
         # get json from posted body
         search_term = json.get("searchTerm", "")
+        page = json.get("page", 1)
+        cursor = json.get("cursor")
+        if (
+                not isinstance(search_term, str) or
+                not isinstance(page, int) or
+                not isinstance(cursor, (str, type(None)))
+        ):
+            abort(HTTPStatus.BAD_REQUEST)
+        # the sort key (-score, id) of the last result of the previous page
+        after = None
+        if cursor is not None:
+            after = decode_cursor(cursor, ((int, float), int))
 
-        # search for search term in the question text
-        # search is case insensitive
-        questions_db = Question.query.filter(
-            Question.question.ilike(f"%{search_term}%")
-        ).all()
+        # search for search term in the question and answer text
+        # search is case insensitive, results are ranked and capped
+        start_index = (page - 1) * QUESTIONS_PER_PAGE
+        ids, total_questions, next_after = search_backend.search(
+            search_term, start_index, QUESTIONS_PER_PAGE, after
+        )
 
-        questions = [q.format() for q in questions_db]
-        total_questions = len(questions)
+        # if page requested is out of range -> return 404 not found
+        if after is None and (
+            page < 1 or (page > 1 and start_index >= total_questions)
+        ):
+            abort(HTTPStatus.NOT_FOUND)
+
+        if question_snapshot is not None:
+            questions = [q.format() for q in question_snapshot.get_many(ids)]
+        else:
+            questions = format_rows(search.fetch_ranked(ids))
 
         result = {
             "questions": questions,
             "total_questions": total_questions,
             "current_category": None,
+            "next_cursor": None if next_after is None
+            else encode_cursor(*next_after),
         }
 
-        return jsonify(result), HTTPStatus.OK
+        return json_response(result)
 
     """
     Create a GET endpoint to get questions based on category.
@@ -195,20 +340,70 @@ def create_app(test_config=None):
     """
 
     @app.route("/categories/<int:key>/questions")
+    @replica_reads
+    @caching.conditional
     def get_question_by_category(key: int):
+        if question_snapshot is not None:
+            return get_question_by_category_snapshot(key)
+
         category = Category.query.get_or_404(key)
-        questions_db = Question.query.filter(
-            Question.category == category.id
-        ).all()
+        query = question_query().filter(Question.category == category.id)
+        data_version, _ = caching.current_version()
+        total_questions = question_stats.total(data_version, category.id)
+
+        # ?stream=true returns every question of the category, the body is
+        # generated while reading the rows so memory stays bounded
+        if request.args.get("stream", "").lower() in ("1", "true"):
+            body = stream_rows(
+                query, Question.id, total_questions, {"current_category": key}
+            )
+            return app.response_class(
+                stream_with_context(body),
+                status=HTTPStatus.OK,
+                mimetype="application/json",
+            )
+
+        # paginated like GET /questions
+        # an empty category has an empty first page
+        rows, total_questions, extra = paginate_request(
+            query, Question.id, QUESTIONS_PER_PAGE, allow_empty=True,
+            total=total_questions,
+        )
+        result = {
+            "questions": format_rows(rows),
+            "total_questions": total_questions,
+            "current_category": key,
+            **extra,
+        }
+
+        return json_response(result)
+
+    def get_question_by_category_snapshot(key: int):
+        if key not in category_registry.categories():
+            abort(HTTPStatus.NOT_FOUND)
+
+        # the questions are already in memory, streaming would not help
+        if request.args.get("stream", "").lower() in ("1", "true"):
+            questions_db = question_snapshot.get_many(
+                question_snapshot.ids(key)
+            )
+            total_questions = len(questions_db)
+            extra = {}
+        else:
+            questions_db, total_questions, extra = \
+                question_snapshot.paginate_request(
+                    key, QUESTIONS_PER_PAGE, allow_empty=True
+                )
+
         questions = [q.format() for q in questions_db]
-        total_questions = len(questions)
         result = {
             "questions": questions,
             "total_questions": total_questions,
             "current_category": key,
+            **extra,
         }
 
-        return jsonify(result), HTTPStatus.OK
+        return json_response(result)
 
     """
     Create a POST endpoint to get questions to play the quiz.
@@ -227,38 +422,169 @@ def create_app(test_config=None):
     """
 
     @app.route("/quizzes", methods=["POST"])
+    @replica_reads
     def get_next_quiz_question():
         json = request.get_json()
 
+        # "count": N returns up to N questions at once in "questions"
+        # instead of one in "question", fewer at the end of the quiz
+        count = json.get("count")
+        if count is not None and (
+            not isinstance(count, int)
+            or isinstance(count, bool)
+            or not 1 <= count <= max_quiz_count
+        ):
+            abort(HTTPStatus.BAD_REQUEST)
+
+        # quiz session started by an earlier request, the server knows
+        # which questions are left so previous_questions is not needed
+        quiz_id = json.get("quiz_id")
+        # sessions do not track the answers, they cannot be adaptive
+        adaptive = json.get("adaptive", False)
+        if adaptive and (quiz_id is not None or json.get("session", False)):
+            abort(HTTPStatus.BAD_REQUEST)
+        if quiz_id is not None:
+            if not isinstance(quiz_id, str):
+                abort(HTTPStatus.BAD_REQUEST)
+            try:
+                if count is not None:
+                    questions = sessions.next_questions(
+                        quiz_sessions, quiz_id, count, fetch_questions
+                    )
+                else:
+                    question = sessions.next_question(
+                        quiz_sessions, quiz_id, fetch_question
+                    )
+            except KeyError:
+                # unknown or expired session
+                abort(HTTPStatus.NOT_FOUND)
+            if count is not None:
+                return jsonify({
+                    "questions": [q.format() for q in questions],
+                    "quiz_id": quiz_id,
+                }), HTTPStatus.OK
+            if question is not None:
+                question = question.format()
+            return jsonify({"question": question, "quiz_id": quiz_id}), \
+                HTTPStatus.OK
+
         # get previous questions from posted json
         # default value is an empty array
         previous_questions = json.get("previous_questions", [])
         # quiz category, if any
         quiz_category = json.get("quiz_category", None)
 
-        # possible questions are questions which have NOT been asked before
-        possible_questions = Question.query.filter(
-            Question.id.notin_(previous_questions)
-        )
+        # if a category is specified, then only pick from the category we want
+        category_id = None
+        if quiz_category is not None:
+            try:
+                category_id = int(quiz_category.get("id", 0))
+            except (TypeError, ValueError):
+                abort(HTTPStatus.BAD_REQUEST)
+            if category_id == 0:
+                category_id = None
+
+        # only questions of this difficulty, or in adaptive mode the
+        # difficulty of the first question
+        difficulty = json.get("difficulty")
+        if difficulty is not None and (
+            not isinstance(difficulty, int) or isinstance(difficulty, bool)
+        ):
+            abort(HTTPStatus.BAD_REQUEST)
 
-        # if a category is specified, then only keep the category we want
-        if quiz_category is not None and quiz_category.get("id") != 0:
-            possible_questions = possible_questions.filter(
-                Question.category == quiz_category.get("id")
+        # "session": true starts a quiz session, the first question is
+        # returned together with the quiz_id to send on the next requests
+        if json.get("session", False):
+            quiz_id = sessions.start(
+                quiz_sessions, question_index, category_id,
+                previous_questions, difficulty=difficulty,
             )
+            if count is not None:
+                questions = sessions.next_questions(
+                    quiz_sessions, quiz_id, count, fetch_questions
+                )
+                return jsonify({
+                    "questions": [q.format() for q in questions],
+                    "quiz_id": quiz_id,
+                }), HTTPStatus.OK
+            question = sessions.next_question(
+                quiz_sessions, quiz_id, fetch_question
+            )
+            if question is not None:
+                question = question.format()
+            return jsonify({"question": question, "quiz_id": quiz_id}), \
+                HTTPStatus.OK
+
+        # "adaptive": true picks the difficulty from "answers", whether
+        # each previous question was answered correctly
+        if adaptive:
+            # the difficulty of each question depends on the answer to
+            # the previous one
+            if count is not None:
+                abort(HTTPStatus.BAD_REQUEST)
+            answers = json.get("answers", [])
+            if not isinstance(answers, list) or not all(
+                isinstance(answer, bool) for answer in answers
+            ):
+                abort(HTTPStatus.BAD_REQUEST)
+            question = question_index.choose_adaptive(
+                category_id, previous_questions, answers,
+                fetch=fetch_question,
+                start=quiz.DEFAULT_DIFFICULTY if difficulty is None
+                else difficulty,
+            )
+            if question is not None:
+                question = question.format()
+            return jsonify({"question": question}), HTTPStatus.OK
+
+        # N distinct random questions which have NOT been asked before
+        if count is not None:
+            questions = question_index.choose_many(
+                count, category_id, previous_questions,
+                fetch_many=fetch_questions, difficulty=difficulty,
+            )
+            return jsonify({"questions": [q.format() for q in questions]}), \
+                HTTPStatus.OK
 
-        # actually fetch from db
-        possible_questions = possible_questions.all()
-
-        # if list is not empty then choose a random question, else return None
-        if len(possible_questions) > 0:
-            question = random.choice(possible_questions).format()
-        else:
-            question = None
+        # pick a random question which has NOT been asked before
+        # None signals that there are no questions left
+        question = question_index.choose(
+            category_id, previous_questions, fetch=fetch_question,
+            difficulty=difficulty,
+        )
+        if question is not None:
+            question = question.format()
 
         result = {"question": question}
         return jsonify(result), HTTPStatus.OK
 
+    """
+    Number of questions overall, per category and per difficulty,
+    see stats.py
+    """
+
+    @app.route("/stats")
+    @replica_reads
+    @caching.conditional
+    def get_stats():
+        data_version, _ = caching.current_version()
+        return json_response(question_stats.summary(
+            data_version, category_registry.categories(data_version)
+        ))
+
+    """
+    Request latency and SQL statement metrics of this process in the
+    Prometheus text format, see metrics.py
+    """
+
+    @app.route("/metrics")
+    def get_metrics():
+        return app.response_class(
+            request_metrics.render(),
+            status=HTTPStatus.OK,
+            content_type=metrics.CONTENT_TYPE,
+        )
+
     @app.errorhandler(HTTPStatus.BAD_REQUEST)
     def bad_request_400(error):
         return (
@@ -298,6 +624,20 @@ def create_app(test_config=None):
             HTTPStatus.UNPROCESSABLE_ENTITY,
         )
 
+    @app.errorhandler(HTTPStatus.TOO_MANY_REQUESTS)
+    def too_many_requests_429(error):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": HTTPStatus.TOO_MANY_REQUESTS,
+                    "message": HTTPStatus.TOO_MANY_REQUESTS.phrase,
+                }
+            ),
+            HTTPStatus.TOO_MANY_REQUESTS,
+            {"Retry-After": str(error.retry_after or 1)},
+        )
+
     @app.errorhandler(HTTPStatus.INTERNAL_SERVER_ERROR)
     def internal_server_error_500(error):
         return (
@@ -311,4 +651,18 @@ def create_app(test_config=None):
             HTTPStatus.INTERNAL_SERVER_ERROR,
         )
 
+    @app.errorhandler(HTTPStatus.SERVICE_UNAVAILABLE)
+    def service_unavailable_503(error):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": HTTPStatus.SERVICE_UNAVAILABLE,
+                    "message": HTTPStatus.SERVICE_UNAVAILABLE.phrase,
+                }
+            ),
+            HTTPStatus.SERVICE_UNAVAILABLE,
+            {"Retry-After": str(error.retry_after or 1)},
+        )
+
     return app
@@ -0,0 +1,272 @@
+import asyncio
+import io
+import sys
+from http import HTTPStatus
+
+from flask.testing import FlaskClient
+from sqlalchemy.util import await_only, greenlet_spawn
+from werkzeug.test import run_wsgi_app
+
+from models import db
+from . import create_app
+
+"""
+ASGI entry point
+
+create_asgi_app returns an ASGI application serving the same routes, error
+handlers and responses as create_app, on an asyncio event loop and with
+the asyncio driver of the database (asyncpg for postgres, which has to be
+installed).
+
+Every request runs the flask app in its own greenlet through SQLAlchemy's
+greenlet_spawn. The routes stay synchronous code, but each database call
+awaits the driver: while a request waits on postgres the event loop serves
+the other requests instead of a worker thread being held.
+
+    uvicorn flaskr.asgi:create_asgi_app --factory
+
+The flask app, and so the connection to the database, is created on the
+lifespan startup event, or on the first request with servers which do not
+send lifespan events.
+"""
+
+
+def _environ(scope, body):
+    """
+    returns the WSGI environ of the ASGI http `scope`
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "")
+        .encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", ()):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = f"HTTP_{name}"
+        if name in environ:
+            value = f"{environ[name]},{value}"
+        environ[name] = value
+    return environ
+
+
+def _scope(environ):
+    """
+    returns the ASGI http scope of the WSGI `environ`, for the test client
+    """
+    headers = []
+    for name, value in environ.items():
+        # werkzeug's test environ has both CONTENT_TYPE and
+        # HTTP_CONTENT_TYPE, keep the first
+        if name.startswith("HTTP_") and \
+                name[5:] not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            name = name[5:]
+        elif name not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            continue
+        headers.append((
+            name.lower().replace("_", "-").encode("latin-1"),
+            value.encode("latin-1"),
+        ))
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": environ["REQUEST_METHOD"],
+        "scheme": environ["wsgi.url_scheme"],
+        "root_path": environ.get("SCRIPT_NAME", "")
+        .encode("latin-1").decode("utf-8"),
+        "path": environ["PATH_INFO"].encode("latin-1").decode("utf-8"),
+        "query_string": environ.get("QUERY_STRING", "").encode("latin-1"),
+        "headers": headers,
+        "server": (environ["SERVER_NAME"], int(environ["SERVER_PORT"])),
+        "client": (environ.get("REMOTE_ADDR", ""), 0),
+    }
+
+
+class AsgiApp:
+    def __init__(self, test_config=None):
+        self.config = dict(test_config or {}, DB_ASYNC_DRIVER=True)
+        # the flask app, created on startup
+        self.app = None
+        self._startup_lock = None
+        self._loop = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.startup()
+            body = b""
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get("body", b"")
+                more_body = message.get("more_body", False)
+            await greenlet_spawn(
+                self._handle, _environ(scope, body), send
+            )
+        else:
+            raise ValueError(f"unsupported scope type {scope['type']!r}")
+
+    async def startup(self):
+        if self._startup_lock is None:
+            self._startup_lock = asyncio.Lock()
+        async with self._startup_lock:
+            if self.app is None:
+                # setup_db migrates the schema through the async driver
+                self.app = await greenlet_spawn(create_app, self.config)
+
+    async def shutdown(self):
+        if self.app is not None:
+            await greenlet_spawn(self._dispose)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as error:
+                    await send({
+                        "type": "lifespan.startup.failed",
+                        "message": str(error),
+                    })
+                    raise
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _handle(self, environ, send):
+        # runs in the request's greenlet, await_only hands the sends to the
+        # event loop
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [
+                (name.lower().encode("latin-1"), value.encode("latin-1"))
+                for name, value in headers
+            ]
+
+        def send_start():
+            await_only(send({
+                "type": "http.response.start",
+                "status": started.pop("status"),
+                "headers": started.pop("headers"),
+            }))
+
+        chunks = self.app.wsgi_app(environ, start_response)
+        try:
+            # streamed bodies are sent chunk by chunk as they are generated
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if "status" in started:
+                    send_start()
+                await_only(send({
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": True,
+                }))
+        finally:
+            # ends the request context, which can use the db
+            if hasattr(chunks, "close"):
+                chunks.close()
+        if "status" in started:
+            send_start()
+        await_only(send({"type": "http.response.body", "body": b""}))
+
+    def _dispose(self):
+        with self.app.app_context():
+            binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+            for bind in [None, *binds]:
+                db.get_engine(self.app, bind=bind).dispose()
+
+    # testing
+
+    def start(self):
+        """
+        creates the flask app on the event loop of the test client and
+        returns it. Set DB_ASYNC_FALLBACK in the config for tests to use
+        the database directly outside of requests.
+        """
+        self._run(self.startup())
+        return self.app
+
+    def test_client(self, use_cookies=True, **kwargs):
+        self.start()
+        return AsgiTestClient(
+            self, self.app.response_class, use_cookies=use_cookies, **kwargs
+        )
+
+    def wsgi(self, environ, start_response):
+        """
+        calls the ASGI app as a WSGI app, the whole body is buffered
+        """
+        body = environ["wsgi.input"].read()
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        self._run(self(_scope(environ), receive, send))
+
+        start = messages[0]
+        start_response(
+            f"{start['status']} {HTTPStatus(start['status']).phrase}",
+            [
+                (name.decode("latin-1"), value.decode("latin-1"))
+                for name, value in start["headers"]
+            ],
+        )
+        return [message.get("body", b"") for message in messages[1:]]
+
+    def _run(self, awaitable):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        # the async driver's fallback mode runs on the current event loop
+        asyncio.set_event_loop(self._loop)
+        return self._loop.run_until_complete(awaitable)
+
+
+class AsgiTestClient(FlaskClient):
+    """
+    flask's test client, sending the requests through the ASGI app
+    """
+
+    def __init__(self, asgi_app, *args, **kwargs):
+        super().__init__(asgi_app.app, *args, **kwargs)
+        self.asgi_app = asgi_app
+
+    def run_wsgi_app(self, environ, buffered=False):
+        if self.cookie_jar is not None:
+            self.cookie_jar.inject_wsgi(environ)
+        rv = run_wsgi_app(self.asgi_app.wsgi, environ, buffered=buffered)
+        if self.cookie_jar is not None:
+            self.cookie_jar.extract_wsgi(environ, rv[2])
+        return rv
+
+
+def create_asgi_app(test_config=None):
+    return AsgiApp(test_config)
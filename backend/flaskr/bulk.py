@@ -0,0 +1,279 @@
+import re
+from collections import Counter
+
+import click
+from flask import json
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from models import (
+    db, bump_data_version, update_question_counts, Category, Question,
+)
+from . import changes
+from .serialization import question_query
+
+"""
+Bulk import and export of questions
+
+Questions are exchanged as JSON Lines, one question object per line with
+the same attributes as POST /questions. Imports validate the lines as they
+are read and insert them with one executemany per chunk of rows, all in a
+single transaction, instead of one INSERT and one commit per question.
+Exports stream the rows from a server side cursor.
+
+import_dump loads the categories and questions of a pg_dump file such as
+trivia.psql into any database, which is how sqlite and in-memory databases
+get their data: set DATABASE_SEED to a dump (or a JSON Lines file) and it
+is imported when the app starts on a database without questions.
+"""
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# rows fetched per round trip when exporting
+EXPORT_BATCH_SIZE = 1000
+
+FIELDS = {
+    "question": str,
+    "answer": str,
+    "category": int,
+    "difficulty": int,
+}
+
+
+# tables read from a dump and their integer columns
+DUMP_TABLES = {
+    "categories": (Category.__table__, {"id"}),
+    "questions": (Question.__table__, {"id", "difficulty", "category"}),
+}
+
+_copy = re.compile(r"COPY (?:\w+\.)?(\w+) \(([^)]*)\) FROM stdin;")
+_copy_escape = re.compile(r"\\(.)")
+_copy_escapes = {"t": "\t", "n": "\n", "r": "\r", "b": "\b", "f": "\f",
+                 "v": "\v"}
+
+
+class BulkImportError(ValueError):
+    def __init__(self, line, reason):
+        super().__init__(f"line {line}: {reason}")
+        self.line = line
+        self.reason = reason
+
+
+def parse_line(line):
+    """
+    returns the question row of a JSON line, raises ValueError if the
+    line is not a valid question
+    """
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise ValueError("invalid JSON")
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+
+    row = {}
+    for name, kind in FIELDS.items():
+        value = data.get(name)
+        if value is None:
+            raise ValueError(f"missing {name}")
+        # bool is a subclass of int but not a valid category or difficulty
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise ValueError(f"{name} must be of type {kind.__name__}")
+        row[name] = value
+    return row
+
+
+def parse_lines(lines):
+    """
+    generates the question rows of an iterable of JSON lines (str or
+    bytes), blank lines are skipped. raises BulkImportError on the first
+    invalid line
+    """
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if not line.strip():
+            continue
+        try:
+            yield parse_line(line)
+        except ValueError as error:
+            raise BulkImportError(number, str(error))
+
+
+def import_questions(lines, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    inserts the questions of `lines` in a single transaction, `chunk_size`
+    rows per executemany. returns the number of questions inserted.
+    nothing is inserted if any line is invalid or an insert fails
+    """
+    insert = Question.__table__.insert()
+    inserted = 0
+    chunk = []
+    # (category, difficulty) -> questions inserted
+    counts = Counter()
+    try:
+        for row in parse_lines(lines):
+            chunk.append(row)
+            counts[row["category"], row["difficulty"]] += 1
+            if len(chunk) >= chunk_size:
+                db.session.execute(insert, chunk)
+                inserted += len(chunk)
+                chunk = []
+        if chunk:
+            db.session.execute(insert, chunk)
+            inserted += len(chunk)
+        if inserted > 0:
+            connection = db.session.connection()
+            update_question_counts(connection, counts)
+            bump_data_version(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    # the rows bypassed the ORM, in-memory indexes have to be rebuilt
+    if inserted > 0:
+        changes.notify_reset()
+    return inserted
+
+
+def _copy_value(value):
+    if value == "\\N":
+        return None
+    return _copy_escape.sub(
+        lambda match: _copy_escapes.get(match.group(1), match.group(1)),
+        value,
+    )
+
+
+def parse_dump(lines):
+    """
+    returns {table name: [row, ...]} of the COPY blocks of the
+    DUMP_TABLES in a pg_dump file
+    """
+    tables = {name: [] for name in DUMP_TABLES}
+    rows = columns = integers = None
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.rstrip("\n")
+        if rows is None:
+            match = _copy.match(line)
+            if match and match.group(1) in DUMP_TABLES:
+                rows = tables[match.group(1)]
+                columns = [c.strip() for c in match.group(2).split(",")]
+                integers = DUMP_TABLES[match.group(1)][1]
+            continue
+        if line == "\\.":
+            rows = None
+            continue
+        row = dict(zip(columns, map(_copy_value, line.split("\t"))))
+        for column in integers & row.keys():
+            if row[column] is not None:
+                row[column] = int(row[column])
+        rows.append(row)
+    return tables
+
+
+def import_dump(lines):
+    """
+    inserts the categories and questions of a pg_dump file, keeping their
+    ids, in a single transaction. returns the number of rows inserted
+    """
+    tables = parse_dump(lines)
+    inserted = 0
+    try:
+        for name, (table, _) in DUMP_TABLES.items():
+            if tables[name]:
+                db.session.execute(table.insert(), tables[name])
+                inserted += len(tables[name])
+        if inserted > 0:
+            connection = db.session.connection()
+            if connection.dialect.name == "postgresql":
+                # the ids were given, move the sequences past them
+                for name in DUMP_TABLES:
+                    connection.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('{name}', "
+                        f"'id'), coalesce(max(id), 1)) FROM {name}"
+                    ))
+            update_question_counts(connection, Counter(
+                (row.get("category"), row.get("difficulty"))
+                for row in tables["questions"]
+            ))
+            bump_data_version(connection)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if inserted > 0:
+        changes.notify_reset()
+    return inserted
+
+
+def seed(app):
+    """
+    imports DATABASE_SEED, a pg_dump (.psql, .sql) or JSON Lines file,
+    if the database has no questions and no categories
+    """
+    path = app.config.get("DATABASE_SEED")
+    if not path:
+        return
+    with app.app_context():
+        if Question.query.first() or Category.query.first():
+            return
+        with open(path, "rb") as source:
+            if path.endswith((".psql", ".sql")):
+                import_dump(source)
+            else:
+                import_questions(source)
+
+
+def export_questions(batch_size=EXPORT_BATCH_SIZE):
+    """
+    generates every question as a JSON line, ordered by id
+    """
+    rows = question_query().order_by(Question.id).yield_per(batch_size)
+    for row in rows:
+        yield json.dumps(row._asdict()) + "\n"
+
+
+questions_cli = AppGroup("questions", help="Bulk import and export questions.")
+
+
+@questions_cli.command("import")
+@click.argument("source", type=click.File("rb"))
+@click.option(
+    "--chunk-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_CHUNK_SIZE,
+    show_default=True,
+    help="Rows inserted per statement.",
+)
+def import_command(source, chunk_size):
+    """Import questions from a JSON Lines file ('-' for stdin)."""
+    try:
+        inserted = import_questions(source, chunk_size)
+    except BulkImportError as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Imported {inserted} questions.")
+
+
+@questions_cli.command("import-dump")
+@click.argument("source", type=click.File("rb"))
+def import_dump_command(source):
+    """Import the categories and questions of a pg_dump file."""
+    inserted = import_dump(source)
+    click.echo(f"Imported {inserted} rows.")
+
+
+@questions_cli.command("export")
+@click.argument("target", type=click.File("w"), default="-")
+def export_command(target):
+    """Export all questions as JSON Lines to a file (stdout by default)."""
+    for line in export_questions():
+        target.write(line)
+
+
+def init_app(app):
+    app.cli.add_command(questions_cli)
@@ -0,0 +1,80 @@
+from functools import wraps
+from http import HTTPStatus
+
+from flask import current_app, g, request
+
+from models import get_data_version
+
+"""
+HTTP caching
+
+Responses of views decorated with conditional carry an ETag derived from the
+data version (see models.py), a Last-Modified date and a Cache-Control
+header. A request whose If-None-Match or If-Modified-Since shows the client
+already has the current version gets an empty 304 Not Modified response
+without the view running, which only costs the lookup of the data version.
+
+In snapshot mode the version is the one the snapshot was loaded at, so the
+ETag always matches what the snapshot serves.
+"""
+
+DEFAULT_MAX_AGE = 0
+
+
+def current_version():
+    """
+    returns (version, updated_at) of the data this process serves,
+    the result is kept for the rest of the request
+    """
+    if "data_version" not in g:
+        snapshot = current_app.extensions.get("question_snapshot")
+        if snapshot is not None:
+            g.data_version = snapshot.version, snapshot.updated_at
+        else:
+            g.data_version = get_data_version()
+    return g.data_version
+
+
+def make_etag(version):
+    return f"v{version}"
+
+
+def conditional(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version, updated_at = current_version()
+        etag = make_etag(version)
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = (
+                updated_at is not None
+                and request.if_modified_since is not None
+                and updated_at.replace(microsecond=0)
+                <= request.if_modified_since.replace(tzinfo=None)
+            )
+
+        if not_modified:
+            response = current_app.response_class(
+                status=HTTPStatus.NOT_MODIFIED
+            )
+        else:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != HTTPStatus.OK:
+                return response
+
+        # weak, the bytes differ when the response is compressed
+        response.set_etag(etag, weak=True)
+        if updated_at is not None:
+            response.last_modified = updated_at
+        response.cache_control.public = True
+        max_age = current_app.config.get("HTTP_CACHE_MAX_AGE",
+                                         DEFAULT_MAX_AGE)
+        response.cache_control.max_age = max_age
+        if max_age == 0:
+            # may be stored but has to be revalidated
+            response.cache_control.no_cache = True
+        return response
+
+    return wrapper
@@ -0,0 +1,119 @@
+import threading
+import time
+
+from flask import current_app, has_app_context, json
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+
+from models import db, Category
+
+"""
+Category registry
+
+Categories are read on almost every request but nearly never change, so the
+id -> type mapping and the serialized /categories body are cached in
+process. Writes to Category through the ORM invalidate the cache once they
+are committed, the ttl bounds how long a worker can miss a change made by
+another process. Callers which know the current data version (see
+models.py) can pass it to reload as soon as it changed.
+"""
+
+DEFAULT_TTL = 60
+
+
+class CategoryRegistry:
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        # bumped on every invalidation
+        self.version = 0
+
+        self._lock = threading.Lock()
+        self._categories = None
+        self._body = None
+        self._loaded_at = 0.0
+        self._data_version = None
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._categories = None
+            self._body = None
+
+    def categories(self, data_version=None):
+        """
+        returns a dict of category id -> category type
+        """
+        with self._lock:
+            if not self._expired(data_version):
+                return self._categories
+            version = self.version
+
+        # read without holding the lock, see quiz.QuestionIndex._loaded
+        rows = db.session.query(Category.id, Category.type) \
+            .order_by(Category.type).all()
+
+        with self._lock:
+            categories = dict(rows)
+            # an invalidation while reading may have been missed
+            if version == self.version:
+                self._categories = categories
+                self._body = None
+                self._loaded_at = time.monotonic()
+                self._data_version = data_version
+            return categories
+
+    def json_body(self, data_version=None):
+        """
+        returns the serialized body of GET /categories as bytes
+        """
+        categories = self.categories(data_version)
+        with self._lock:
+            if self._categories is categories and self._body is not None:
+                return self._body
+            body = json.dumps({"categories": categories}).encode("utf-8")
+            if self._categories is categories:
+                self._body = body
+            return body
+
+    def _expired(self, data_version):
+        return (
+            self._categories is None
+            or time.monotonic() - self._loaded_at > self.ttl
+            or (
+                data_version is not None
+                and data_version != self._data_version
+            )
+        )
+
+
+def init_app(app):
+    ttl = app.config.get("CATEGORY_CACHE_TTL", DEFAULT_TTL)
+    registry = CategoryRegistry(ttl=ttl)
+    app.extensions["category_registry"] = registry
+    return registry
+
+
+# remember that categories were written in this transaction
+@event.listens_for(Category, "after_insert")
+@event.listens_for(Category, "after_update")
+@event.listens_for(Category, "after_delete")
+def _category_written(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info["categories_changed"] = True
+
+
+# and only drop the cache once the transaction is committed
+@event.listens_for(db.session, "after_commit")
+def _invalidate_on_commit(session):
+    if not session.info.pop("categories_changed", False):
+        return
+    if has_app_context():
+        registry = current_app.extensions.get("category_registry")
+        if registry is not None:
+            registry.invalidate()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_on_rollback(session):
+    session.info.pop("categories_changed", None)
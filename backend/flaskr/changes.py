@@ -0,0 +1,109 @@
+from flask import current_app, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import object_session
+
+from models import db, Category, Question
+
+"""
+Question change feed
+
+In-memory indexes over the question bank subscribe here to stay in sync
+with the database. Question rows written through the ORM are collected
+while the session flushes and handed to the subscribers of the current app
+once the transaction commits, rolled back writes are never delivered.
+
+A subscriber implements:
+    question_inserted(row)  row is a dict shaped like Question.format()
+    question_deleted(row)
+    version_bumped(count)   after the changes of a transaction, which
+                            bumped the data version (see models.py) count
+                            times: without writes by other processes in
+                            the meantime, the data version is now the one
+                            the subscriber knew plus count
+    reset()                 drop everything, called after writes that
+                            bypass the ORM (e.g. bulk imports)
+"""
+
+
+def subscribe(app, subscriber):
+    app.extensions.setdefault("question_subscribers", []).append(subscriber)
+
+
+def subscribers(app=None):
+    app = app or current_app
+    return app.extensions.get("question_subscribers", [])
+
+
+def notify_reset(app=None):
+    for subscriber in subscribers(app):
+        subscriber.reset()
+
+
+def _record(target, change):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault("question_changes", []).append(change)
+
+
+def _previous_row(target):
+    # values the row had before this flush
+    state = inspect(target)
+    row = target.format()
+    for key in row:
+        history = state.attrs[key].history
+        if history.deleted:
+            row[key] = history.deleted[0]
+    return row
+
+
+@event.listens_for(Question, "after_insert")
+def _question_inserted(mapper, connection, target):
+    _record(target, ("insert", target.format()))
+
+
+@event.listens_for(Question, "after_update")
+def _question_updated(mapper, connection, target):
+    _record(target, ("delete", _previous_row(target)))
+    _record(target, ("insert", target.format()))
+
+
+@event.listens_for(Question, "after_delete")
+def _question_deleted(mapper, connection, target):
+    _record(target, ("delete", target.format()))
+
+
+# every ORM write of a question or a category bumps the data version once
+@event.listens_for(Question, "after_insert")
+@event.listens_for(Question, "after_update")
+@event.listens_for(Question, "after_delete")
+@event.listens_for(Category, "after_insert")
+@event.listens_for(Category, "after_update")
+@event.listens_for(Category, "after_delete")
+def _count_bump(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info["data_version_bumps"] = \
+            session.info.get("data_version_bumps", 0) + 1
+
+
+@event.listens_for(db.session, "after_commit")
+def _deliver_on_commit(session):
+    changes = session.info.pop("question_changes", [])
+    bumps = session.info.pop("data_version_bumps", 0)
+    if not (changes or bumps) or not has_app_context():
+        return
+
+    for subscriber in subscribers():
+        for kind, row in changes:
+            if kind == "insert":
+                subscriber.question_inserted(row)
+            else:
+                subscriber.question_deleted(row)
+        if bumps:
+            subscriber.version_bumped(bumps)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_on_rollback(session):
+    session.info.pop("question_changes", None)
+    session.info.pop("data_version_bumps", None)
@@ -0,0 +1,143 @@
+import gzip
+import threading
+import zlib
+from collections import OrderedDict
+from http import HTTPStatus
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+"""
+Response compression
+
+JSON responses of at least COMPRESS_MIN_SIZE bytes are compressed with
+brotli (if the brotli package is installed) or gzip, whichever the client
+prefers in Accept-Encoding. Streamed responses are gzipped chunk by chunk
+as they are generated.
+
+Responses carrying an ETag (see caching.py) are the same bytes until the
+data changes, so their compressed bytes are kept in a small LRU cache keyed
+by url, ETag and encoding and compressed only once.
+"""
+
+DEFAULT_MIN_SIZE = 500
+DEFAULT_LEVEL = 6
+DEFAULT_CACHE_SIZE = 256
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson"}
+
+
+def _gzip(body, level):
+    # mtime=0 so the same body always gives the same bytes
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _brotli(body, level):
+    # brotli quality goes up to 11, gzip levels up to 9
+    return brotli.compress(body, quality=min(level, 11))
+
+
+ENCODERS = {"gzip": _gzip}
+if brotli is not None:
+    ENCODERS["br"] = _brotli
+
+
+def gzip_stream(chunks, level):
+    # wbits 16 + MAX_WBITS writes a gzip header and trailer
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class CompressedCache:
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self._lock:
+            self._entries[key] = body
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def choose_encoding(accept_encodings):
+    """
+    returns the encoding the client prefers among ENCODERS, None if it
+    accepts none of them
+    """
+    best, best_quality = None, 0
+    # prefer brotli on equal quality, it compresses JSON better
+    for encoding in sorted(ENCODERS, key=lambda e: e != "br"):
+        quality = accept_encodings[encoding]
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def init_app(app):
+    min_size = app.config.get("COMPRESS_MIN_SIZE", DEFAULT_MIN_SIZE)
+    level = app.config.get("COMPRESS_LEVEL", DEFAULT_LEVEL)
+    cache = CompressedCache(
+        app.config.get("COMPRESS_CACHE_SIZE", DEFAULT_CACHE_SIZE)
+    )
+    app.extensions["compressed_cache"] = cache
+
+    @app.after_request
+    def compress(response):
+        if (
+            response.status_code != HTTPStatus.OK
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers
+        ):
+            return response
+
+        response.vary.add("Accept-Encoding")
+
+        if response.is_streamed:
+            if request.accept_encodings["gzip"]:
+                response.response = gzip_stream(response.response, level)
+                response.headers.pop("Content-Length", None)
+                response.headers["Content-Encoding"] = "gzip"
+            return response
+
+        if response.content_length is not None and \
+                response.content_length < min_size:
+            return response
+
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        etag, _ = response.get_etag()
+        key = (request.full_path, etag, encoding)
+        body = cache.get(key) if etag else None
+        if body is None:
+            body = ENCODERS[encoding](response.get_data(), level)
+            if etag:
+                cache.put(key, body)
+
+        response.set_data(body)
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+    return cache
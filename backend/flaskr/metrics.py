@@ -0,0 +1,269 @@
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+Request and database metrics
+
+Every request is counted per route, method and status. A sampled fraction
+of the requests (METRICS_SAMPLE_RATE, 1 by default) is also timed, and so
+are the SQL statements they run, through engine events. For those requests
+the statements are grouped by SQL text: one statement run more than
+METRICS_N_PLUS_ONE_THRESHOLD times is an N+1 pattern, a SELECT returning
+more than METRICS_LARGE_RESULT_ROWS rows a large result. Both are counted
+and logged. The row count comes from the driver, sqlite does not report it
+for SELECTs.
+
+GET /metrics renders everything in the Prometheus text format. The metrics
+are per process, with several workers each one reports its own.
+"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_SAMPLE_RATE = 1.0
+DEFAULT_N_PLUS_ONE_THRESHOLD = 10
+DEFAULT_LARGE_RESULT_ROWS = 1000
+
+# seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0,
+)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005) + LATENCY_BUCKETS
+QUERIES_PER_REQUEST_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return ",".join(
+        f'{name}="{_escape(value)}"' for name, value in labels
+    )
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._latency = {}
+        self._queries = Counter()
+        self._query_time = {}
+        self._queries_per_request = {}
+        self._n_plus_one = Counter()
+        self._large_results = Counter()
+
+    def record_request(self, route, method, status):
+        with self._lock:
+            self._requests[(route, method, status)] += 1
+
+    def record_sample(self, route, method, duration, statements):
+        """
+        records a sampled request which took `duration` seconds and ran
+        `statements`, a list of (sql, seconds, rows)
+        """
+        with self._lock:
+            self._histogram(self._latency, (route, method),
+                            LATENCY_BUCKETS).observe(duration)
+            self._histogram(self._queries_per_request, (route,),
+                            QUERIES_PER_REQUEST_BUCKETS) \
+                .observe(len(statements))
+            query_time = self._histogram(self._query_time, (route,),
+                                         QUERY_BUCKETS)
+            for _, seconds, _ in statements:
+                query_time.observe(seconds)
+            self._queries[route] += len(statements)
+
+    def record_n_plus_one(self, route):
+        with self._lock:
+            self._n_plus_one[route] += 1
+
+    def record_large_result(self, route):
+        with self._lock:
+            self._large_results[route] += 1
+
+    def _histogram(self, histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    def render(self):
+        """
+        returns the metrics in the Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            self._render_counter(
+                lines, "trivia_http_requests_total",
+                "HTTP requests by route, method and status",
+                ("route", "method", "status"), self._requests,
+            )
+            self._render_histogram(
+                lines, "trivia_http_request_duration_seconds",
+                "Latency of the sampled requests",
+                ("route", "method"), self._latency,
+            )
+            self._render_counter(
+                lines, "trivia_db_queries_total",
+                "SQL statements run by the sampled requests",
+                ("route",), {(k,): v for k, v in self._queries.items()},
+            )
+            self._render_histogram(
+                lines, "trivia_db_query_duration_seconds",
+                "Duration of the SQL statements of the sampled requests",
+                ("route",), self._query_time,
+            )
+            self._render_histogram(
+                lines, "trivia_db_queries_per_request",
+                "SQL statements per sampled request",
+                ("route",), self._queries_per_request,
+            )
+            self._render_counter(
+                lines, "trivia_db_n_plus_one_total",
+                "Sampled requests running one statement more than the "
+                "N+1 threshold",
+                ("route",), {(k,): v for k, v in self._n_plus_one.items()},
+            )
+            self._render_counter(
+                lines, "trivia_db_large_results_total",
+                "SELECTs of the sampled requests returning more rows than "
+                "the threshold",
+                ("route",),
+                {(k,): v for k, v in self._large_results.items()},
+            )
+        return "\n".join(lines) + "\n"
+
+    def _render_counter(self, lines, name, description, label_names,
+                        values):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(values.items()):
+            labels = _labels(zip(label_names, key))
+            lines.append(f"{name}{{{labels}}} {value}")
+
+    def _render_histogram(self, lines, name, description, label_names,
+                          histograms):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, histogram in sorted(histograms.items()):
+            labels = list(zip(label_names, key))
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ("+Inf",),
+                                    histogram.counts):
+                cumulative += count
+                bucket_labels = _labels(labels + [("le", bound)])
+                lines.append(
+                    f"{name}_bucket{{{bucket_labels}}} {cumulative}"
+                )
+            lines.append(f"{name}_sum{{{_labels(labels)}}} {histogram.sum}")
+            lines.append(
+                f"{name}_count{{{_labels(labels)}}} {histogram.count}"
+            )
+
+
+def _route():
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def init_app(app):
+    """
+    call it before the other extensions so the timings include their
+    before_request and after_request hooks
+    """
+    sample_rate = float(
+        app.config.get("METRICS_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)
+    )
+    n_plus_one_threshold = app.config.get(
+        "METRICS_N_PLUS_ONE_THRESHOLD", DEFAULT_N_PLUS_ONE_THRESHOLD
+    )
+    metrics = Metrics()
+    app.extensions["metrics"] = metrics
+
+    @app.before_request
+    def start_timer():
+        if sample_rate >= 1 or random.random() < sample_rate:
+            g.metrics_start = time.perf_counter()
+            # (sql, seconds, rows) of the statements of the request
+            g.metrics_statements = []
+
+    # after_request functions run in the reverse order they were registered
+    # in, this one runs last
+    @app.after_request
+    def record(response):
+        route = _route()
+        metrics.record_request(route, request.method, response.status_code)
+
+        start = g.pop("metrics_start", None)
+        if start is None:
+            return response
+        statements = g.pop("metrics_statements")
+        metrics.record_sample(route, request.method,
+                              time.perf_counter() - start, statements)
+
+        repeated = Counter(sql for sql, _, _ in statements)
+        sql, times = repeated.most_common(1)[0] if repeated else (None, 0)
+        if times > n_plus_one_threshold:
+            metrics.record_n_plus_one(route)
+            app.logger.warning(
+                "N+1 queries: %s ran %d times in %s %s",
+                sql, times, request.method, route,
+            )
+        return response
+
+    return metrics
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if has_request_context() and "metrics_statements" in g:
+        conn.info.setdefault("metrics_query_start", []) \
+            .append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    starts = conn.info.get("metrics_query_start")
+    if not starts or not has_request_context() or \
+            "metrics_statements" not in g:
+        return
+    seconds = time.perf_counter() - starts.pop()
+    rows = cursor.rowcount
+    g.metrics_statements.append((statement, seconds, rows))
+
+    threshold = current_app.config.get(
+        "METRICS_LARGE_RESULT_ROWS", DEFAULT_LARGE_RESULT_ROWS
+    )
+    if rows > threshold and statement.lstrip()[:6].upper() == "SELECT":
+        metrics = current_app.extensions.get("metrics")
+        if metrics is not None:
+            metrics.record_large_result(_route())
+        current_app.logger.warning(
+            "large result: %d rows for %s in %s %s",
+            rows, statement, request.method, _route(),
+        )
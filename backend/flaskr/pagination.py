@@ -0,0 +1,163 @@
+import base64
+from http import HTTPStatus
+
+from flask import abort, json, request
+
+"""
+Pagination helpers
+
+The helpers let the database do the work: the total is a COUNT, unless
+the caller already knows it (see stats.py), and only the rows of the
+requested page are fetched and turned into ORM objects.
+
+Paginated responses carry a next_cursor, an opaque token of the sort key
+of their last row (null on the last page). Passed back as ?cursor= it
+returns the rows following that one: unlike ?page=, rows inserted or
+deleted meanwhile do not make the client skip or repeat any row, and the
+cost does not depend on how deep the page is.
+"""
+
+# rows fetched per round trip when streaming
+STREAM_BATCH_SIZE = 100
+
+
+def paginate(query, key, page, per_page, allow_empty=False, total=None):
+    """
+    Returns (rows, total) for page `page` of `query` ordered by `key`
+    using LIMIT/OFFSET. Aborts with 404 if the page is out of range,
+    with allow_empty the first page of an empty result is not an error.
+    `total` is counted if not given.
+    """
+    if total is None:
+        total = query.order_by(None).count()
+
+    start_index = (page - 1) * per_page
+    if page < 1 or (start_index >= total and not (allow_empty and page == 1)):
+        abort(HTTPStatus.NOT_FOUND)
+
+    rows = query.order_by(key).offset(start_index).limit(per_page).all()
+    return rows, total
+
+
+def encode_cursor(*values):
+    """
+    returns the cursor of the sort key `values`
+    """
+    data = json.dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor, types):
+    """
+    returns the sort key of `cursor` as a list, aborts with 400 unless it
+    was made by encode_cursor from values of `types`
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (TypeError, ValueError):
+        abort(HTTPStatus.BAD_REQUEST)
+    if (
+        not isinstance(values, list)
+        or len(values) != len(types)
+        or not all(
+            isinstance(value, kind) and not isinstance(value, bool)
+            for value, kind in zip(values, types)
+        )
+    ):
+        abort(HTTPStatus.BAD_REQUEST)
+    return values
+
+
+def paginate_after(query, key, after, per_page, total=None,
+                   allow_empty=False):
+    """
+    Keyset pagination: returns (rows, total, next_after) for the `per_page`
+    rows of `query` whose `key` is greater than `after`.
+    The cost does not depend on how deep the page is, unlike OFFSET.
+    next_after is None on the last page.
+    Aborts with 404 if there are no rows after `after`, unless allow_empty.
+    """
+    if total is None:
+        total = query.order_by(None).count()
+
+    # fetch one extra row to know whether there is a next page
+    rows = query.filter(key > after).order_by(key).limit(per_page + 1).all()
+    if len(rows) == 0 and not allow_empty:
+        abort(HTTPStatus.NOT_FOUND)
+
+    next_after = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_after = getattr(rows[-1], key.key)
+
+    return rows, total, next_after
+
+
+def paginate_request(query, key, per_page, allow_empty=False, total=None):
+    """
+    Paginates `query` as asked by the ?cursor=, ?after_id= or ?page=
+    arguments of the current request. Returns (rows, total, extra) where
+    extra holds the fields to add to the response: next_cursor, and
+    next_after_id in keyset mode.
+    """
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        after, = decode_cursor(cursor, (int,))
+        # the row the cursor points at may have been deleted since, the
+        # rows after it are still the next ones
+        rows, total, next_after = paginate_after(
+            query, key, after, per_page, total, allow_empty=True
+        )
+        return rows, total, {"next_cursor": next_cursor(next_after)}
+
+    after_id = request.args.get("after_id", type=int)
+    if after_id is not None:
+        rows, total, next_after_id = paginate_after(
+            query, key, after_id, per_page, total
+        )
+        return rows, total, {
+            "next_after_id": next_after_id,
+            "next_cursor": next_cursor(next_after_id),
+        }
+
+    page = request.args.get("page", default=1, type=int)
+    rows, total = paginate(query, key, page, per_page, allow_empty, total)
+    more = (page - 1) * per_page + len(rows) < total
+    return rows, total, {
+        "next_cursor": next_cursor(getattr(rows[-1], key.key))
+        if rows and more else None,
+    }
+
+
+def next_cursor(after):
+    return None if after is None else encode_cursor(after)
+
+
+def stream_rows(query, key, total, fields, batch_size=STREAM_BATCH_SIZE):
+    """
+    Generates the JSON object `fields` + {"questions": [...],
+    "total_questions": total} piece by piece, `query` selects the question
+    columns (see serialization.question_query). Rows are read from a
+    server side cursor `batch_size` at a time so memory stays bounded
+    however many rows `query` returns.
+    """
+    body = dict(fields, questions=None, total_questions=total)
+    # same key order as jsonify, which sorts keys
+    keys = sorted(body)
+
+    yield "{"
+    for i, name in enumerate(keys):
+        if i > 0:
+            yield ", "
+        yield json.dumps(name) + ": "
+        if name != "questions":
+            yield json.dumps(body[name])
+            continue
+
+        yield "["
+        rows = query.order_by(key).yield_per(batch_size)
+        for j, row in enumerate(rows):
+            yield (", " if j > 0 else "") + json.dumps(row._asdict())
+        yield "]"
+    yield "}"
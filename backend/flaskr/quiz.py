@@ -0,0 +1,412 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from models import db, get_data_version, Question
+from . import changes
+
+"""
+Quiz question selection
+
+QuestionIndex keeps the ids of all questions in memory, bucketed by
+category and difficulty: one bucket per (category, difficulty) plus the
+buckets of every question, of each category and of each difficulty. The
+buckets are built once when the app starts and then follow the writes
+through the change feed, an insert or delete only touches the buckets of
+that question.
+
+Picking the next quiz question samples an id of the bucket at random and
+rejects it if it was already asked, so a pick costs O(1) for most of the
+quiz instead of loading every remaining question from the db.
+Only when nearly all candidates were asked do we fall back to scanning the
+candidate ids, which still never touches the db.
+
+In adaptive mode the difficulty of the next question follows the player's
+answers (see adaptive_difficulty), falling back to the nearest difficulty
+with questions left.
+
+Writes made by other processes are picked up by comparing the data version
+(see models.py) with the one the index follows, at most every
+`poll_interval` seconds; the writes of this process advance that version
+through the change feed, so they do not cause a rebuild. The index is
+rebuilt when the versions differ, and after `ttl` seconds in any case.
+With QUIZ_SHARED_INDEX the processes share one index instead, see
+shared_index.py.
+"""
+
+DEFAULT_TTL = 300
+DEFAULT_POLL_INTERVAL = 1.0
+
+# difficulty of the first question of an adaptive quiz
+DEFAULT_DIFFICULTY = 3
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 5
+
+# random picks to try before scanning the candidates
+MAX_REJECTIONS = 16
+
+
+class IdSet:
+    """
+    set of ids supporting O(1) add, discard and random choice
+    """
+
+    def __init__(self, ids=()):
+        self._ids = []
+        self._positions = {}
+        for key in ids:
+            self.add(key)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def add(self, key):
+        if key not in self._positions:
+            self._positions[key] = len(self._ids)
+            self._ids.append(key)
+
+    def discard(self, key):
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        # move the last id into the hole so removal is O(1)
+        last = self._ids.pop()
+        if last != key:
+            self._ids[position] = last
+            self._positions[last] = position
+
+    def choice(self, rng=random):
+        return self._ids[rng.randrange(len(self._ids))]
+
+
+# bucket key part matching every category or difficulty
+_ANY = object()
+
+
+class QuestionIndex:
+    def __init__(self, ttl=DEFAULT_TTL, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        # (category, difficulty) -> IdSet, either can be _ANY
+        self._buckets = None
+        # id -> (category, difficulty)
+        self._rows = None
+        self._loaded_at = 0.0
+        # data version the index is up to date with
+        self._data_version = None
+        self._checked_at = 0.0
+        # bumped on every change, to detect changes made during a load
+        self._changes = 0
+
+    # change feed subscriber
+
+    def question_inserted(self, row):
+        with self._lock:
+            self._changes += 1
+            if self._buckets is not None:
+                self._add(row["id"], row["category"], row["difficulty"])
+
+    def question_deleted(self, row):
+        with self._lock:
+            self._changes += 1
+            if self._buckets is not None:
+                self._discard(row["id"])
+
+    def version_bumped(self, count):
+        with self._lock:
+            if self._data_version is not None:
+                self._data_version += count
+
+    def reset(self):
+        with self._lock:
+            self._changes += 1
+            self._buckets = None
+            self._rows = None
+
+    def load(self):
+        """
+        builds the index now instead of on the first pick
+        """
+        with self._loaded():
+            pass
+
+    # selection
+
+    def candidates(self, category=None, difficulty=None):
+        """
+        returns a list of the ids of the questions in `category` (all if
+        None) of `difficulty` (any if None)
+        """
+        with self._loaded():
+            return list(self._bucket(category, difficulty) or ())
+
+    def difficulties(self, category=None):
+        """
+        returns the sorted difficulties of the questions in `category`
+        (all if None)
+        """
+        category = _ANY if category is None else category
+        with self._loaded():
+            return sorted(
+                difficulty for (key, difficulty), ids in self._buckets.items()
+                if key == category and difficulty is not _ANY
+                and difficulty is not None and ids
+            )
+
+    def choose_id(self, category=None, asked=(), rng=random,
+                  difficulty=None):
+        """
+        returns a random id of a question in `category` (any if None) of
+        `difficulty` (any if None) that is not in `asked`, None if there
+        is no such question
+        """
+        asked = asked if isinstance(asked, (set, frozenset)) else set(asked)
+        with self._loaded():
+            ids = self._bucket(category, difficulty)
+            if not ids:
+                return None
+
+            for _ in range(MAX_REJECTIONS):
+                key = ids.choice(rng)
+                if key not in asked:
+                    return key
+
+            remaining = [key for key in ids if key not in asked]
+            if len(remaining) == 0:
+                return None
+            return rng.choice(remaining)
+
+    def choose(self, category=None, asked=(), rng=random, fetch=None,
+               difficulty=None):
+        """
+        same as choose_id but returns the question, loaded with
+        fetch(id) (Question.query.get by default), skipping ids of
+        questions deleted by another process in the meantime
+        """
+        fetch = fetch or Question.query.get
+        while True:
+            key = self.choose_id(category, asked, rng, difficulty)
+            if key is None:
+                return None
+            question = fetch(key)
+            if question is not None:
+                return question
+            with self._lock:
+                self._discard(key)
+
+    def sample_ids(self, count, category=None, asked=(), rng=random,
+                   difficulty=None):
+        """
+        returns up to `count` distinct random ids of questions in
+        `category` (any if None) of `difficulty` (any if None) that are
+        not in `asked`, fewer if there are not enough left
+        """
+        asked = asked if isinstance(asked, (set, frozenset)) else set(asked)
+        with self._loaded():
+            ids = self._bucket(category, difficulty)
+            if not ids:
+                return []
+
+            chosen = []
+            taken = set()
+            rejections = 0
+            while len(chosen) < count and rejections < MAX_REJECTIONS:
+                key = ids.choice(rng)
+                if key in asked or key in taken:
+                    rejections += 1
+                    continue
+                taken.add(key)
+                chosen.append(key)
+
+            if len(chosen) < count:
+                remaining = [
+                    key for key in ids
+                    if key not in asked and key not in taken
+                ]
+                chosen += rng.sample(
+                    remaining, min(count - len(chosen), len(remaining))
+                )
+            return chosen
+
+    def choose_many(self, count, category=None, asked=(), rng=random,
+                    fetch_many=None, difficulty=None):
+        """
+        same as sample_ids but returns the questions, loaded with
+        fetch_many(ids) (fetch_questions by default) in a single call per
+        round, questions deleted in the meantime are replaced
+        """
+        fetch_many = fetch_many or fetch_questions
+        asked = set(asked)
+        questions = []
+        while len(questions) < count:
+            keys = self.sample_ids(count - len(questions), category, asked,
+                                   rng, difficulty)
+            if not keys:
+                break
+            found = fetch_many(keys)
+            questions += found
+            asked.update(keys)
+            if len(found) < len(keys):
+                found_keys = {question.id for question in found}
+                with self._lock:
+                    for key in keys:
+                        if key not in found_keys:
+                            self._discard(key)
+        return questions
+
+    def choose_adaptive(self, category=None, asked=(), answers=(),
+                        rng=random, fetch=None, start=DEFAULT_DIFFICULTY):
+        """
+        same as choose, for the difficulty adaptive_difficulty picks from
+        `answers`, or the nearest one with questions left
+        """
+        asked = set(asked)
+        target = adaptive_difficulty(answers, start)
+        nearest = sorted(
+            self.difficulties(category),
+            key=lambda difficulty: (abs(difficulty - target), difficulty),
+        )
+        for difficulty in nearest:
+            question = self.choose(category, asked, rng, fetch, difficulty)
+            if question is not None:
+                return question
+        return None
+
+    def _bucket(self, category, difficulty):
+        return self._buckets.get((
+            _ANY if category is None else category,
+            _ANY if difficulty is None else difficulty,
+        ))
+
+    @contextmanager
+    def _loaded(self):
+        """
+        holds the lock with the index loaded. The ids are read from the db
+        without holding it: under the ASGI entry point requests share a
+        thread, one waiting on the db must not block the others.
+        """
+        with self._lock:
+            expired = self._expired()
+            if not expired and not self._check_due():
+                yield
+                return
+            changes = self._changes
+
+        # read the version first, the rows are at least as recent
+        version, _ = get_data_version()
+        if not expired:
+            with self._lock:
+                self._checked_at = time.monotonic()
+                if version == self._data_version:
+                    yield
+                    return
+
+        rows = db.session.query(
+            Question.id, Question.category, Question.difficulty
+        ).all()
+
+        with self._lock:
+            self._buckets = {}
+            self._rows = {}
+            for key, category, difficulty in rows:
+                self._add(key, category, difficulty)
+            self._data_version = version
+            self._checked_at = time.monotonic()
+            # a write committed while reading may be missing, reload on
+            # the next call
+            self._loaded_at = time.monotonic() \
+                if changes == self._changes else 0.0
+            yield
+
+    def _expired(self):
+        return (
+            self._buckets is None
+            or time.monotonic() - self._loaded_at > self.ttl
+        )
+
+    def _check_due(self):
+        return time.monotonic() - self._checked_at >= self.poll_interval
+
+    def _add(self, key, category, difficulty):
+        self._discard(key)
+        self._rows[key] = (category, difficulty)
+        for bucket in (
+            (_ANY, _ANY),
+            (category, _ANY),
+            (_ANY, difficulty),
+            (category, difficulty),
+        ):
+            self._buckets.setdefault(bucket, IdSet()).add(key)
+
+    def _discard(self, key):
+        if self._rows is None or key not in self._rows:
+            return
+        category, difficulty = self._rows.pop(key)
+        for bucket in (
+            (_ANY, _ANY),
+            (category, _ANY),
+            (_ANY, difficulty),
+            (category, difficulty),
+        ):
+            self._buckets[bucket].discard(key)
+
+
+def fetch_questions(keys):
+    """
+    returns the questions of the ids `keys` in that order, skipping
+    missing ones, in a single query
+    """
+    questions = {
+        question.id: question
+        for question in Question.query.filter(Question.id.in_(keys))
+    }
+    return [questions[key] for key in keys if key in questions]
+
+
+def adaptive_difficulty(answers, start=DEFAULT_DIFFICULTY):
+    """
+    returns the difficulty of the next question given `answers`, whether
+    each previous question was answered correctly in order: one step up
+    after a correct answer, one down after a wrong one
+    """
+    difficulty = start
+    for correct in answers:
+        if correct:
+            difficulty = min(MAX_DIFFICULTY, difficulty + 1)
+        else:
+            difficulty = max(MIN_DIFFICULTY, difficulty - 1)
+    return difficulty
+
+
+def init_app(app):
+    path = app.config.get("QUIZ_SHARED_INDEX")
+    if path:
+        from . import shared_index
+
+        index = shared_index.SharedQuestionIndex(
+            path, poll_interval=app.config.get(
+                "QUIZ_SHARED_INDEX_POLL", shared_index.DEFAULT_POLL_INTERVAL
+            ),
+        )
+    else:
+        index = QuestionIndex(
+            ttl=app.config.get("QUIZ_INDEX_TTL", DEFAULT_TTL),
+            poll_interval=app.config.get(
+                "QUIZ_INDEX_POLL_INTERVAL", DEFAULT_POLL_INTERVAL
+            ),
+        )
+    app.extensions["question_index"] = index
+    changes.subscribe(app, index)
+    if app.config.get("QUIZ_INDEX_PRELOAD", True):
+        with app.app_context():
+            index.load()
+    return index
@@ -0,0 +1,182 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from http import HTTPStatus
+
+from flask import abort, current_app, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+"""
+Rate limiting and admission control
+
+The write and search endpoints are unauthenticated, so every client gets a
+token bucket per route. A limit is (requests per second, burst): the bucket
+holds up to `burst` tokens and refills at the given rate, a request takes a
+token and a client with an empty bucket gets 429 with a Retry-After header.
+
+- RATE_LIMITS: view name -> limit, merged over DEFAULT_LIMITS. None
+  removes the limit of a route.
+- RATE_LIMIT_CLIENTS: client key -> {view name: limit}, overrides for
+  single clients (None exempts the client from that route's limit)
+- RATE_LIMIT_CLIENT_KEY: function of the request returning the client key,
+  the remote address by default.
+- TRUSTED_PROXIES: number of reverse proxies in front of the app. Behind a
+  proxy the remote address is the proxy's, every client would share one
+  bucket. With TRUSTED_PROXIES set the remote address is taken from the
+  X-Forwarded-For header those proxies add instead (werkzeug's ProxyFix),
+  only set it when they are the only way in, the header is sent by the
+  client otherwise.
+- RATE_LIMIT_BACKEND: a RateLimitBackend instance keeping the buckets, set
+  it to share them between processes. The default keeps them in process
+  memory, so with several workers a client gets the limit of each one.
+
+MAX_CONCURRENT_REQUESTS caps the number of requests to the limited routes
+being processed at once by the process. Requests beyond it are answered
+503 right away instead of queueing for a database connection.
+"""
+
+# view name -> (requests per second, burst)
+DEFAULT_LIMITS = {
+    "search_questions": (5, 30),
+    "post_new_question": (2, 20),
+    "delete_question": (2, 20),
+    "post_questions_bulk": (0.2, 5),
+}
+DEFAULT_MAX_KEYS = 100000
+
+
+class RateLimitBackend:
+    def take(self, key, rate, burst):
+        """
+        takes a token from the bucket `key`, refilled at `rate` tokens per
+        second up to `burst`. returns (allowed, seconds until a token is
+        available)
+        """
+        raise NotImplementedError
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    in-process buckets, the least recently used ones are dropped once
+    there are more than `max_keys`
+    """
+
+    def __init__(self, max_keys=DEFAULT_MAX_KEYS):
+        self.max_keys = max_keys
+
+        self._lock = threading.Lock()
+        # key -> (tokens, updated_at), least recently used first
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens, updated_at = bucket
+                tokens = min(burst, tokens + (now - updated_at) * rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+
+def remote_address(request):
+    return request.remote_addr or ""
+
+
+class RateLimiter:
+    def __init__(self, backend, limits, clients=None,
+                 client_key=remote_address, max_concurrent=None):
+        self.backend = backend
+        self.limits = limits
+        self.clients = clients or {}
+        self.client_key = client_key
+
+        self._slots = None
+        if max_concurrent:
+            self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    def check(self, endpoint):
+        """
+        takes a token of the current client for `endpoint`, aborts with
+        429 if there is none
+        """
+        client = self.client_key(request)
+        limit = self.limits.get(endpoint)
+        overrides = self.clients.get(client)
+        if overrides is not None and endpoint in overrides:
+            limit = overrides[endpoint]
+        if limit is None:
+            return
+
+        rate, burst = limit
+        allowed, retry_after = self.backend.take(
+            f"{endpoint}:{client}", rate, burst
+        )
+        if not allowed:
+            abort(HTTPStatus.TOO_MANY_REQUESTS,
+                  retry_after=math.ceil(retry_after))
+
+    @contextmanager
+    def admitted(self):
+        """
+        holds one of the max_concurrent slots, aborts with 503 if they are
+        all taken
+        """
+        if self._slots is None:
+            yield
+            return
+        if not self._slots.acquire(blocking=False):
+            abort(HTTPStatus.SERVICE_UNAVAILABLE, retry_after=1)
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+
+def init_app(app):
+    proxies = int(app.config.get("TRUSTED_PROXIES") or 0)
+    if proxies > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
+
+    backend = app.config.get("RATE_LIMIT_BACKEND")
+    if backend is None:
+        backend = MemoryRateLimitBackend()
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(app.config.get("RATE_LIMITS") or {})
+
+    limiter = RateLimiter(
+        backend,
+        limits,
+        clients=app.config.get("RATE_LIMIT_CLIENTS"),
+        client_key=app.config.get("RATE_LIMIT_CLIENT_KEY", remote_address),
+        max_concurrent=app.config.get("MAX_CONCURRENT_REQUESTS"),
+    )
+    app.extensions["rate_limiter"] = limiter
+    return limiter
+
+
+def limited(view):
+    """
+    applies the rate limit of the view, then the concurrency cap
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        limiter = current_app.extensions["rate_limiter"]
+        limiter.check(request.endpoint)
+        with limiter.admitted():
+            return view(*args, **kwargs)
+
+    return wrapper
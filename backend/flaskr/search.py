@@ -0,0 +1,365 @@
+import heapq
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+
+from sqlalchemy import and_, cast, func, literal, or_
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from models import db, get_data_version, Question
+from . import changes
+from .serialization import question_query
+
+"""
+Question search
+
+Searching with ilike('%term%') scans the whole table on every keystroke,
+so searches go through a backend instead:
+
+- MemorySearchBackend (default) keeps an inverted index of the words in
+  the question and answer texts in process memory. A search term matches
+  every word it is a prefix of, so partial words typed in the search box
+  already find questions. Matches in the question rank above matches in
+  the answer and every word of the term has to match.
+- PostgresSearchBackend uses postgres full-text search (to_tsvector /
+  plainto_tsquery) and ranks with ts_rank.
+
+The memory backend follows the writes of its process through the change
+feed. Writes by other processes are picked up by comparing the data
+version (see models.py) with the one the index was built at, at most every
+`poll_interval` seconds, the index is rebuilt when they differ and after
+`ttl` seconds in any case.
+
+Both return at most `cap` results, a page of them at a time. Results are
+ordered by the sort key (-score, id), a page can start after the sort key
+of the last result of the previous one instead of at an offset, so
+questions written between two pages do not shift the results.
+"""
+
+DEFAULT_TTL = 300
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_RESULT_CAP = 100
+
+QUESTION_WEIGHT = 2
+ANSWER_WEIGHT = 1
+
+_word = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return _word.findall((text or "").lower())
+
+
+class MemorySearchBackend:
+    def __init__(self, cap=DEFAULT_RESULT_CAP, ttl=DEFAULT_TTL,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.cap = cap
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._loaded_at = 0.0
+        # word -> {question id: weight}
+        self._postings = {}
+        # sorted words, to find all the words starting with a prefix
+        self._words = []
+        # question id -> {word: weight}, needed to remove a question
+        self._documents = {}
+        # data version the index is up to date with
+        self._data_version = None
+        self._checked_at = 0.0
+        # bumped on every change, to detect changes made during a load
+        self._changes = 0
+        # a thread is checking or rebuilding the index
+        self._loading = False
+
+    # change feed subscriber
+
+    def question_inserted(self, row):
+        with self._lock:
+            self._changes += 1
+            if self._loaded:
+                self._add(row["id"], row["question"], row["answer"])
+
+    def question_deleted(self, row):
+        with self._lock:
+            self._changes += 1
+            if self._loaded:
+                self._remove(row["id"])
+
+    def version_bumped(self, count):
+        with self._lock:
+            if self._data_version is not None:
+                self._data_version += count
+
+    def reset(self):
+        with self._lock:
+            self._changes += 1
+            self._loaded = False
+
+    def load(self):
+        """
+        builds the index now instead of on the first search
+        """
+        with self._indexed():
+            pass
+
+    # search
+
+    def search(self, term, offset, limit, after=None):
+        """
+        returns (ids, total, next_after): the ids of the matches ranked
+        from offset to offset + limit, or the `limit` following the sort
+        key `after`, the total number of matches (at most cap) and the sort
+        key of the last id, None if there are no more matches
+        """
+        with self._indexed():
+            ranked = self._rank(tokenize(term))
+        if after is not None:
+            offset = bisect_right(ranked, tuple(after))
+        page = ranked[offset:offset + limit]
+        next_after = None
+        if page and offset + limit < len(ranked):
+            next_after = list(page[-1])
+        return [key for _, key in page], len(ranked), next_after
+
+    def _rank(self, tokens):
+        """
+        returns the sorted sort keys (-score, id) of the first cap matches
+        """
+        # an empty search term matches every question
+        if len(tokens) == 0:
+            return [(0, key)
+                    for key in heapq.nsmallest(self.cap, self._documents)]
+
+        scores = None
+        for token in tokens:
+            token_scores = {}
+            index = bisect_left(self._words, token)
+            while (
+                index < len(self._words)
+                and self._words[index].startswith(token)
+            ):
+                word = self._words[index]
+                # whole word matches rank above prefix matches
+                boost = 2 if word == token else 1
+                for key, weight in self._postings[word].items():
+                    token_scores[key] = \
+                        token_scores.get(key, 0) + weight * boost
+                index += 1
+
+            if scores is None:
+                scores = token_scores
+            else:
+                # every token has to match
+                scores = {
+                    key: score + token_scores[key]
+                    for key, score in scores.items()
+                    if key in token_scores
+                }
+            if not scores:
+                return []
+
+        return heapq.nsmallest(
+            self.cap, ((-score, key) for key, score in scores.items())
+        )
+
+    @contextmanager
+    def _indexed(self):
+        """
+        holds the lock with the index loaded and up to date with the data
+        version. The index is built without holding it and swapped in,
+        searches keep using the current one while another thread checks
+        the version or rebuilds it.
+        """
+        with self._lock:
+            expired = self._expired()
+            if self._loaded and (
+                self._loading or (not expired and not self._check_due())
+            ):
+                yield
+                return
+            self._loading = True
+            changes = self._changes
+
+        try:
+            # read the version first, the rows are at least as recent
+            version, _ = get_data_version()
+            current = False
+            if not expired:
+                with self._lock:
+                    self._checked_at = time.monotonic()
+                    current = version == self._data_version
+            if not current:
+                rows = db.session.query(
+                    Question.id, Question.question, Question.answer
+                ).all()
+                documents = {
+                    key: _document(question, answer)
+                    for key, question, answer in rows
+                }
+                postings = {}
+                for key, document in documents.items():
+                    for word, weight in document.items():
+                        postings.setdefault(word, {})[key] = weight
+                words = sorted(postings)
+        except BaseException:
+            with self._lock:
+                self._loading = False
+            raise
+
+        with self._lock:
+            self._loading = False
+            if not current:
+                self._postings = postings
+                self._words = words
+                self._documents = documents
+                self._loaded = True
+                self._data_version = version
+                self._checked_at = time.monotonic()
+                # a write committed while reading may be missing, reload
+                # on the next search
+                self._loaded_at = time.monotonic() \
+                    if changes == self._changes else 0.0
+            yield
+
+    def _expired(self):
+        return (
+            not self._loaded
+            or time.monotonic() - self._loaded_at > self.ttl
+        )
+
+    def _check_due(self):
+        return time.monotonic() - self._checked_at >= self.poll_interval
+
+    def _add(self, key, question, answer):
+        self._remove(key)
+
+        document = _document(question, answer)
+        self._documents[key] = document
+        for word, weight in document.items():
+            if word not in self._postings:
+                self._postings[word] = {}
+                insort(self._words, word)
+            self._postings[word][key] = weight
+
+    def _remove(self, key):
+        document = self._documents.pop(key, None)
+        if document is None:
+            return
+        for word in document:
+            postings = self._postings[word]
+            postings.pop(key, None)
+            if len(postings) == 0:
+                del self._postings[word]
+                del self._words[bisect_left(self._words, word)]
+
+
+def _document(question, answer):
+    """
+    returns the weight of each word of a question
+    """
+    document = {}
+    for word in tokenize(question):
+        document[word] = document.get(word, 0) + QUESTION_WEIGHT
+    for word in tokenize(answer):
+        document[word] = document.get(word, 0) + ANSWER_WEIGHT
+    return document
+
+
+class PostgresSearchBackend:
+    def __init__(self, cap=DEFAULT_RESULT_CAP, language="english"):
+        self.cap = cap
+        self.language = language
+
+    def load(self):
+        # postgres keeps the index
+        pass
+
+    def search(self, term, offset, limit, after=None):
+        """
+        same as MemorySearchBackend.search, the score is the ts_rank
+        """
+        document = func.to_tsvector(
+            self.language,
+            func.coalesce(Question.question, "")
+            + " "
+            + func.coalesce(Question.answer, ""),
+        )
+
+        query = db.session.query(Question.id)
+        ranked = bool(term.strip())
+        score = literal(0.0)
+        if ranked:
+            ts_query = func.plainto_tsquery(self.language, term)
+            query = query.filter(document.op("@@")(ts_query))
+            # ts_rank is a real, as a double it survives the JSON of the
+            # cursor unchanged
+            score = cast(func.ts_rank(document, ts_query), DOUBLE_PRECISION)
+
+        total = query.order_by(None).limit(self.cap).count()
+        order = [score.desc(), Question.id] if ranked else [Question.id]
+        query = query.add_columns(score.label("score")).order_by(*order)
+        if after is None:
+            limit = max(min(limit, total - offset), 0)
+            query = query.offset(offset)
+        else:
+            # the matches following the sort key after, among the first
+            # cap ones like with an offset
+            capped = query.limit(self.cap).subquery()
+            key, score = capped.c.id, capped.c.score
+            after_score, after_id = -after[0], after[1]
+            following = key > after_id
+            if ranked:
+                following = or_(
+                    score < after_score,
+                    and_(score == after_score, following),
+                )
+            order = [score.desc(), key] if ranked else [key]
+            query = db.session.query(key, score).filter(following) \
+                .order_by(*order)
+
+        # one extra row to know whether there are more
+        rows = query.limit(limit + 1).all()
+        more = len(rows) > limit
+        if after is None:
+            more = more and offset + limit < total
+        rows = rows[:limit]
+        next_after = [-rows[-1][1], rows[-1][0]] if rows and more else None
+        return [key for key, _ in rows], total, next_after
+
+
+def init_app(app):
+    cap = app.config.get("SEARCH_RESULT_CAP", DEFAULT_RESULT_CAP)
+    name = app.config.get("SEARCH_BACKEND", "memory")
+    if name == "memory":
+        backend = MemorySearchBackend(
+            cap=cap,
+            ttl=app.config.get("SEARCH_INDEX_TTL", DEFAULT_TTL),
+            poll_interval=app.config.get(
+                "SEARCH_INDEX_POLL_INTERVAL", DEFAULT_POLL_INTERVAL
+            ),
+        )
+        changes.subscribe(app, backend)
+    elif name == "postgres":
+        backend = PostgresSearchBackend(cap=cap)
+    else:
+        raise ValueError(f"unknown SEARCH_BACKEND {name!r}")
+
+    app.extensions["search_backend"] = backend
+    return backend
+
+
+def fetch_ranked(ids):
+    """
+    loads the question rows (see serialization.question_query) with the
+    given ids, keeping the order of ids
+    """
+    if len(ids) == 0:
+        return []
+    rows = question_query().filter(Question.id.in_(ids)).all()
+    by_id = {row.id: row for row in rows}
+    return [by_id[key] for key in ids if key in by_id]
@@ -0,0 +1,92 @@
+from http import HTTPStatus
+
+from flask import current_app, json, jsonify
+
+from models import db, Question
+
+"""
+Serialization of question lists
+
+List endpoints select the question columns as plain tuples instead of
+loading full ORM objects and turning each one into a dict with format(),
+and encode the response with the encoder set by JSON_ENCODER:
+
+- "json" (default): flask's encoder, the body is byte for byte the one
+  jsonify returns
+- "orjson": orjson, which has to be installed. Faster, but non-ASCII text
+  is written as UTF-8 instead of \\u escapes, the JSON is the same
+- or any callable taking the payload and returning str or bytes
+
+In debug mode, where jsonify pretty prints, jsonify is always used.
+"""
+
+QUESTION_COLUMNS = (
+    Question.id,
+    Question.question,
+    Question.answer,
+    Question.category,
+    Question.difficulty,
+)
+
+
+def question_query():
+    """
+    returns a query of the question columns as tuples, filter and
+    paginate it like Question.query
+    """
+    return db.session.query(*QUESTION_COLUMNS)
+
+
+def format_rows(rows):
+    """
+    turns rows of question_query() into dicts shaped like Question.format()
+    """
+    return [row._asdict() for row in rows]
+
+
+def _json_dumps(payload):
+    # the same arguments jsonify uses when it does not pretty print
+    return json.dumps(payload, separators=(",", ":"))
+
+
+def _orjson_dumps():
+    import orjson
+
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+    def dumps(payload):
+        return orjson.dumps(payload, option=options)
+
+    return dumps
+
+
+def init_app(app):
+    encoder = app.config.get("JSON_ENCODER", "json")
+    if encoder == "json":
+        dumps = _json_dumps
+    elif encoder == "orjson":
+        dumps = _orjson_dumps()
+    elif callable(encoder):
+        dumps = encoder
+    else:
+        raise ValueError(f"unknown JSON_ENCODER {encoder!r}")
+
+    app.extensions["json_dumps"] = dumps
+    return dumps
+
+
+def json_response(payload, status=HTTPStatus.OK):
+    app = current_app
+    if app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug:
+        response = jsonify(payload)
+        response.status_code = status
+        return response
+
+    body = app.extensions["json_dumps"](payload)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return app.response_class(
+        body + b"\n",
+        status=status,
+        mimetype=app.config["JSONIFY_MIMETYPE"],
+    )
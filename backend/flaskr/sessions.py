@@ -0,0 +1,171 @@
+import random
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from models import Question
+from .quiz import fetch_questions
+
+"""
+Quiz sessions
+
+Instead of sending every previously asked question id with each request,
+a client can start a quiz session. The server then keeps a shuffled deck
+of the ids that are left to ask and each request only sends the quiz_id,
+getting the next question is a pop from the deck.
+
+The store is pluggable: anything implementing QuizSessionStore can be set
+as app.config["QUIZ_SESSION_STORE"], the default keeps the decks in
+process memory and evicts the least recently used sessions.
+"""
+
+DEFAULT_TTL = 3600
+DEFAULT_MAX_SESSIONS = 10000
+
+
+class QuizSessionStore:
+    def create(self, deck):
+        """
+        stores a deck (a sequence of question ids) and returns its quiz_id
+        """
+        raise NotImplementedError
+
+    def pop(self, quiz_id):
+        """
+        removes and returns the next question id of the session,
+        None when the deck is empty.
+        raises KeyError if the session does not exist or has expired
+        """
+        raise NotImplementedError
+
+    def delete(self, quiz_id):
+        raise NotImplementedError
+
+
+class MemoryQuizSessionStore(QuizSessionStore):
+    """
+    in-process store, sessions expire `ttl` seconds after their last use
+    and the least recently used session is evicted once there are more
+    than `max_sessions`
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+
+        self._lock = threading.Lock()
+        # quiz_id -> [deck, expires_at], least recently used first
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self, deck):
+        quiz_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._evict(time.monotonic())
+            self._sessions[quiz_id] = [
+                array("l", deck),
+                time.monotonic() + self.ttl,
+            ]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return quiz_id
+
+    def pop(self, quiz_id):
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(quiz_id)
+            if session is None or session[1] < now:
+                self._sessions.pop(quiz_id, None)
+                raise KeyError(quiz_id)
+
+            session[1] = now + self.ttl
+            self._sessions.move_to_end(quiz_id)
+
+            deck = session[0]
+            if len(deck) == 0:
+                return None
+            return deck.pop()
+
+    def delete(self, quiz_id):
+        with self._lock:
+            self._sessions.pop(quiz_id, None)
+
+    def _evict(self, now):
+        # sessions are ordered by last use so expired ones come first
+        while self._sessions:
+            quiz_id, session = next(iter(self._sessions.items()))
+            if session[1] >= now:
+                break
+            del self._sessions[quiz_id]
+
+
+def init_app(app):
+    store = app.config.get("QUIZ_SESSION_STORE")
+    if store is None:
+        store = MemoryQuizSessionStore(
+            ttl=app.config.get("QUIZ_SESSION_TTL", DEFAULT_TTL),
+            max_sessions=app.config.get(
+                "QUIZ_SESSION_MAX", DEFAULT_MAX_SESSIONS
+            ),
+        )
+    app.extensions["quiz_sessions"] = store
+    return store
+
+
+def start(store, question_index, category=None, asked=(), rng=random,
+          difficulty=None):
+    """
+    starts a session over the questions of `category` (all if None) of
+    `difficulty` (any if None) that are not in `asked` and returns its
+    quiz_id
+    """
+    asked = set(asked)
+    deck = [
+        key for key in question_index.candidates(category, difficulty)
+        if key not in asked
+    ]
+    rng.shuffle(deck)
+    return store.create(deck)
+
+
+def next_question(store, quiz_id, fetch=None):
+    """
+    returns the next question of the session, loaded with fetch(id)
+    (Question.query.get by default), None when the quiz is over.
+    raises KeyError for an unknown or expired quiz_id
+    """
+    fetch = fetch or Question.query.get
+    while True:
+        key = store.pop(quiz_id)
+        if key is None:
+            return None
+        # skip questions deleted since the session started
+        question = fetch(key)
+        if question is not None:
+            return question
+
+
+def next_questions(store, quiz_id, count, fetch_many=None):
+    """
+    returns the next `count` questions of the session (fewer at the end of
+    the quiz), loaded with fetch_many(ids) (quiz.fetch_questions by
+    default). raises KeyError for an unknown or expired quiz_id
+    """
+    fetch_many = fetch_many or fetch_questions
+    questions = []
+    while len(questions) < count:
+        keys = []
+        while len(questions) + len(keys) < count:
+            key = store.pop(quiz_id)
+            if key is None:
+                break
+            keys.append(key)
+        if not keys:
+            break
+        # questions deleted since the session started are skipped
+        questions += fetch_many(keys)
+    return questions
@@ -0,0 +1,336 @@
+import fcntl
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+from models import db, get_data_version, Question
+from .quiz import QuestionIndex, _ANY
+
+"""
+Quiz index shared between processes
+
+With QUIZ_SHARED_INDEX set to a file path, ideally on a memory backed file
+system such as /dev/shm, the quiz question ids are not loaded by every
+worker. One process builds the buckets of QuestionIndex into that file and
+the workers map it read-only, so the ids are in memory once however many
+workers run, and the questions are read from the db once per change
+instead of once per worker.
+
+Every QUIZ_SHARED_INDEX_POLL seconds, and after a write through the
+process, a worker compares the data version (see models.py) with the
+version of the file. When the data changed, the first worker to take the
+lock file rebuilds the index into a new file which replaces the old one,
+the others keep using the old one meanwhile and map the new one once it is
+there. Mapped files stay valid after they are replaced, a request never
+sees a half written index.
+
+Nothing waits for a lock: under the ASGI entry point the requests of a
+process share one thread, a request waiting for another one would block
+it. A request which finds no file yet while another request or process is
+building it reads the ids into process memory instead, until the file is
+there.
+
+File layout, native byte order:
+    header      magic, format, data version, number of buckets, of ids
+    buckets     (flags, category, difficulty, offset, length) each, the
+                flags mark any or no category or difficulty
+    ids         int32 ids of the buckets, one after the other
+"""
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+MAGIC = b"TQIX"
+FORMAT = 2
+_header = struct.Struct("=4sIqII")
+_bucket = struct.Struct("=qqqqq")
+
+_ANY_CATEGORY = 1
+_NO_CATEGORY = 2
+_ANY_DIFFICULTY = 4
+_NO_DIFFICULTY = 8
+
+
+def _pack_bucket(category, difficulty, offset, length):
+    flags = 0
+    if category is _ANY:
+        flags |= _ANY_CATEGORY
+    elif category is None:
+        flags |= _NO_CATEGORY
+    if difficulty is _ANY:
+        flags |= _ANY_DIFFICULTY
+    elif difficulty is None:
+        flags |= _NO_DIFFICULTY
+    return _bucket.pack(
+        flags,
+        category if flags & (_ANY_CATEGORY | _NO_CATEGORY) == 0 else 0,
+        difficulty if flags & (_ANY_DIFFICULTY | _NO_DIFFICULTY) == 0 else 0,
+        offset,
+        length,
+    )
+
+
+def _unpack_bucket(view, position):
+    flags, category, difficulty, offset, length = \
+        _bucket.unpack_from(view, position)
+    if flags & _ANY_CATEGORY:
+        category = _ANY
+    elif flags & _NO_CATEGORY:
+        category = None
+    if flags & _ANY_DIFFICULTY:
+        difficulty = _ANY
+    elif flags & _NO_DIFFICULTY:
+        difficulty = None
+    return category, difficulty, offset, length
+
+
+class SharedIds:
+    """
+    read-only bucket of ids over the mapped file, same interface as the
+    IdSet of QuestionIndex for the selection
+    """
+
+    def __init__(self, ids):
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def choice(self, rng=random):
+        return self._ids[rng.randrange(len(self._ids))]
+
+
+def group_ids(rows):
+    """
+    returns the buckets of `rows`, (id, category, difficulty) tuples, as
+    (category, difficulty) -> array of ids
+    """
+    buckets = {}
+    for key, category, difficulty in rows:
+        for bucket in (
+            (_ANY, _ANY),
+            (category, _ANY),
+            (_ANY, difficulty),
+            (category, difficulty),
+        ):
+            buckets.setdefault(bucket, array("i")).append(key)
+    return buckets
+
+
+def write_index(path, version, rows):
+    """
+    writes the index of `rows`, (id, category, difficulty) tuples, at
+    data version `version` to `path`, replacing it at once
+    """
+    buckets = group_ids(rows)
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as target:
+        target.write(_header.pack(
+            MAGIC, FORMAT, version, len(buckets),
+            sum(len(ids) for ids in buckets.values()),
+        ))
+        offset = 0
+        for (category, difficulty), ids in buckets.items():
+            target.write(
+                _pack_bucket(category, difficulty, offset, len(ids))
+            )
+            offset += len(ids)
+        for ids in buckets.values():
+            ids.tofile(target)
+    os.replace(temporary, path)
+
+
+def read_index(path):
+    """
+    maps the index file `path`, returns (data version, buckets) where
+    buckets maps (category, difficulty) to SharedIds, or None if there is
+    no index file yet or it has an older format
+    """
+    try:
+        with open(path, "rb") as source:
+            mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # ValueError: an empty file
+        return None
+
+    view = memoryview(mapped)
+    magic, form, version, bucket_count, id_count = \
+        _header.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a quiz index")
+    if form != FORMAT:
+        # rebuilt in the current format
+        return None
+
+    ids_start = _header.size + bucket_count * _bucket.size
+    ids = view[ids_start:ids_start + id_count * 4].cast("i")
+    buckets = {}
+    for number in range(bucket_count):
+        category, difficulty, offset, length = _unpack_bucket(
+            view, _header.size + number * _bucket.size
+        )
+        buckets[(category, difficulty)] = \
+            SharedIds(ids[offset:offset + length])
+    return version, buckets
+
+
+class SharedQuestionIndex(QuestionIndex):
+    def __init__(self, path, poll_interval=DEFAULT_POLL_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+
+        # data version of the mapped file
+        self.version = None
+        # the buckets were read by this process, not mapped from the file
+        self._private = False
+        self._checked_at = 0.0
+        # ids deleted through this process, until the file has caught up
+        self._deleted = set()
+        self._refresh_lock = threading.Lock()
+
+    # change feed subscriber, the file is rebuilt on the next pick
+
+    def question_inserted(self, row):
+        with self._lock:
+            self._checked_at = 0.0
+
+    def question_deleted(self, row):
+        with self._lock:
+            self._deleted.add(row["id"])
+            self._checked_at = 0.0
+
+    def version_bumped(self, count):
+        # compared with the version of the file instead
+        pass
+
+    def reset(self):
+        with self._lock:
+            self._checked_at = 0.0
+
+    # selection, skipping the ids deleted since the file was built
+
+    def choose_id(self, category=None, asked=(), rng=random,
+                  difficulty=None):
+        return super().choose_id(category, self._skipped(asked), rng,
+                                 difficulty)
+
+    def sample_ids(self, count, category=None, asked=(), rng=random,
+                   difficulty=None):
+        return super().sample_ids(count, category, self._skipped(asked),
+                                  rng, difficulty)
+
+    def candidates(self, category=None, difficulty=None):
+        with self._loaded():
+            return [
+                key for key in self._bucket(category, difficulty) or ()
+                if key not in self._deleted
+            ]
+
+    def _skipped(self, asked):
+        with self._lock:
+            if not self._deleted:
+                return asked
+            return set(asked) | self._deleted
+
+    def _discard(self, key):
+        # the file is read-only
+        self._deleted.add(key)
+
+    @contextmanager
+    def _loaded(self):
+        self._refresh()
+        with self._lock:
+            yield
+
+    def _refresh(self):
+        with self._lock:
+            if (
+                self._buckets is not None
+                and time.monotonic() - self._checked_at < self.poll_interval
+            ):
+                return
+
+        # one request of the process checks, the others use the current
+        # buckets meanwhile
+        if not self._refresh_lock.acquire(blocking=False):
+            if self._buckets is None:
+                self._load_private()
+            return
+        try:
+            version, _ = get_data_version()
+            if self._private or self.version != version:
+                self._map()
+            if self._private or self.version is None or \
+                    self.version < version:
+                self._build(version)
+                self._map()
+            if self._buckets is None:
+                # another process is building the first file
+                self._load_private()
+            with self._lock:
+                # until the file is there the next request looks again
+                if not self._private:
+                    self._checked_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def _map(self):
+        index = read_index(self.path)
+        if index is None:
+            return
+        version, buckets = index
+        with self._lock:
+            if self.version is None or version > self.version:
+                self._deleted = set()
+            self.version = version
+            self._buckets = buckets
+            self._private = False
+
+    def _load_private(self):
+        """
+        reads the buckets into process memory, for the requests served
+        before the first file is there
+        """
+        version, _ = get_data_version()
+        buckets = {
+            bucket: SharedIds(ids)
+            for bucket, ids in group_ids(_question_rows()).items()
+        }
+        with self._lock:
+            if self._buckets is None:
+                self.version = version
+                self._buckets = buckets
+                self._private = True
+
+    def _build(self, version):
+        """
+        rebuilds the file as of `version` unless another process does
+        """
+        with open(f"{self.path}.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                # built by another process since the version was read
+                index = read_index(self.path)
+                if index is not None and index[0] >= version:
+                    return
+                write_index(self.path, version, _question_rows())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _question_rows():
+    return db.session.query(
+        Question.id, Question.category, Question.difficulty
+    ).order_by(Question.id).all()
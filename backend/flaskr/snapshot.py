@@ -0,0 +1,232 @@
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from http import HTTPStatus
+
+from flask import abort, request
+
+from models import db, get_data_version, Question
+from . import changes
+from .pagination import decode_cursor, next_cursor
+
+"""
+Read-only snapshot of the question bank
+
+With SNAPSHOT_MODE the whole question bank is loaded in memory when the app
+starts and the question listing, search and quiz endpoints are served from
+it without touching the db. Questions are compact __slots__ records and the
+ids, overall and per category, are kept in sorted arrays so pages are
+found with a binary search.
+
+Every `poll_interval` seconds the snapshot compares its data version with
+the one in the db (see models.py) and reloads when the data changed, which
+picks up writes made by other processes. Writes through this process are
+seen on the next request.
+"""
+
+DEFAULT_POLL_INTERVAL = 5
+
+
+class QuestionRecord:
+    __slots__ = ("id", "question", "answer", "category", "difficulty")
+
+    def __init__(self, id, question, answer, category, difficulty):
+        self.id = id
+        self.question = question
+        self.answer = answer
+        self.category = category
+        self.difficulty = difficulty
+
+    def format(self):
+        return {
+            "id": self.id,
+            "question": self.question,
+            "answer": self.answer,
+            "category": self.category,
+            "difficulty": self.difficulty,
+        }
+
+
+class QuestionSnapshot:
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+
+        # data version the snapshot was loaded at
+        self.version = None
+        self.updated_at = None
+
+        self._lock = threading.Lock()
+        self._records = {}
+        self._ids = array("l")
+        self._by_category = {}
+        self._polled_at = 0.0
+
+    # change feed subscriber, poll on the next request
+
+    def question_inserted(self, row):
+        self._polled_at = 0.0
+
+    def question_deleted(self, row):
+        self._polled_at = 0.0
+
+    def version_bumped(self, count):
+        pass
+
+    def reset(self):
+        self._polled_at = 0.0
+
+    # loading
+
+    def load(self):
+        """
+        (re)loads every question from the db
+        """
+        # read the version first, the rows are at least as recent
+        version, updated_at = get_data_version()
+        rows = db.session.query(
+            Question.id,
+            Question.question,
+            Question.answer,
+            Question.category,
+            Question.difficulty,
+        ).order_by(Question.id).all()
+
+        records = {}
+        ids = array("l")
+        by_category = {}
+        for row in rows:
+            record = QuestionRecord(*row)
+            records[record.id] = record
+            ids.append(record.id)
+            by_category.setdefault(record.category, array("l")) \
+                .append(record.id)
+
+        with self._lock:
+            self._records = records
+            self._ids = ids
+            self._by_category = by_category
+            self.version = version
+            self.updated_at = updated_at
+            self._polled_at = time.monotonic()
+
+    def refresh(self):
+        """
+        reloads the snapshot if the data version changed, at most once per
+        poll_interval
+        """
+        if time.monotonic() - self._polled_at < self.poll_interval:
+            return
+        version, _ = get_data_version()
+        self._polled_at = time.monotonic()
+        if version != self.version:
+            self.load()
+
+    # reading
+
+    def get(self, key):
+        return self._records.get(key)
+
+    def get_many(self, keys):
+        records = (self._records.get(key) for key in keys)
+        return [record for record in records if record is not None]
+
+    def count(self, category=None):
+        return len(self._ids_of(category))
+
+    def ids(self, category=None):
+        return self._ids_of(category)
+
+    def paginate(self, category, page, per_page, allow_empty=False):
+        """
+        same as pagination.paginate over the questions of `category`
+        (all if None)
+        """
+        with self._lock:
+            ids = self._ids_of(category)
+            total = len(ids)
+            start_index = (page - 1) * per_page
+            if page < 1 or (
+                start_index >= total and not (allow_empty and page == 1)
+            ):
+                abort(HTTPStatus.NOT_FOUND)
+            keys = ids[start_index:start_index + per_page]
+            return self.get_many(keys), total
+
+    def paginate_after(self, category, after, per_page, allow_empty=False):
+        """
+        same as pagination.paginate_after over the questions of
+        `category` (all if None)
+        """
+        with self._lock:
+            ids = self._ids_of(category)
+            start_index = bisect_right(ids, after)
+            keys = ids[start_index:start_index + per_page + 1]
+            if len(keys) == 0 and not allow_empty:
+                abort(HTTPStatus.NOT_FOUND)
+
+            next_after = None
+            if len(keys) > per_page:
+                keys = keys[:per_page]
+                next_after = keys[-1]
+            return self.get_many(keys), len(ids), next_after
+
+    def paginate_request(self, category, per_page, allow_empty=False):
+        """
+        same as pagination.paginate_request
+        """
+        cursor = request.args.get("cursor")
+        if cursor is not None:
+            after, = decode_cursor(cursor, (int,))
+            records, total, next_after = self.paginate_after(
+                category, after, per_page, allow_empty=True
+            )
+            return records, total, {"next_cursor": next_cursor(next_after)}
+
+        after_id = request.args.get("after_id", type=int)
+        if after_id is not None:
+            records, total, next_after_id = self.paginate_after(
+                category, after_id, per_page
+            )
+            return records, total, {
+                "next_after_id": next_after_id,
+                "next_cursor": next_cursor(next_after_id),
+            }
+
+        page = request.args.get("page", default=1, type=int)
+        records, total = self.paginate(category, page, per_page, allow_empty)
+        more = (page - 1) * per_page + len(records) < total
+        return records, total, {
+            "next_cursor": next_cursor(records[-1].id)
+            if records and more else None,
+        }
+
+    def _ids_of(self, category):
+        if category is None:
+            return self._ids
+        return self._by_category.get(category, array("l"))
+
+
+def init_app(app):
+    """
+    returns the snapshot if SNAPSHOT_MODE is on, None otherwise
+    """
+    if not app.config.get("SNAPSHOT_MODE", False):
+        return None
+
+    snapshot = QuestionSnapshot(
+        poll_interval=app.config.get(
+            "SNAPSHOT_POLL_INTERVAL", DEFAULT_POLL_INTERVAL
+        )
+    )
+    with app.app_context():
+        snapshot.load()
+
+    app.extensions["question_snapshot"] = snapshot
+    changes.subscribe(app, snapshot)
+
+    @app.before_request
+    def refresh_snapshot():
+        snapshot.refresh()
+
+    return snapshot
@@ -0,0 +1,71 @@
+import time
+
+import click
+from flask.cli import AppGroup
+
+from migrations import upgrade
+from models import db
+
+"""
+Startup
+
+A new worker pays on its first requests for what is not loaded yet: the
+database connections, the category map, the search and quiz indexes. With
+WARMUP those are set up by create_app instead, so a worker started by an
+autoscaler serves its first requests as fast as the following ones.
+
+create_app connects to the database only for what it is asked to do at
+startup: the schema check (DB_SCHEMA_CHECK, see models.py), DATABASE_SEED,
+QUIZ_INDEX_PRELOAD, SNAPSHOT_MODE and WARMUP. With DB_SCHEMA_CHECK=skip
+and QUIZ_INDEX_PRELOAD off it does not connect at all, the first request
+opens the first connection.
+
+python -m benchmarks.startup compares the startup settings.
+"""
+
+
+def warm_up(app):
+    """
+    fills the connection pools and loads the in-memory caches of `app`,
+    returns the seconds it took
+    """
+    start = time.perf_counter()
+    with app.app_context():
+        binds = [None] + list(app.config.get("SQLALCHEMY_BINDS") or {})
+        for bind in binds:
+            _fill_pool(db.get_engine(app, bind=bind))
+
+        app.extensions["category_registry"].categories()
+        app.extensions["search_backend"].load()
+        app.extensions["question_index"].load()
+        db.session.remove()
+    return time.perf_counter() - start
+
+
+def _fill_pool(engine):
+    # opened at once, then returned to the pool; pools without a size
+    # (sqlite) keep one connection
+    size = getattr(engine.pool, "size", None)
+    connections = [engine.connect() for _ in range(size() if size else 1)]
+    for connection in connections:
+        connection.close()
+
+
+schema_cli = AppGroup("schema", help="Manage the database schema.")
+
+
+@schema_cli.command("upgrade")
+def upgrade_command():
+    """Bring the schema up to date, for DB_SCHEMA_CHECK=skip."""
+    version = upgrade(db.get_engine(), db.metadata)
+    click.echo(f"Schema version {version}.")
+
+
+def init_app(app):
+    """
+    call it last, once the caches it warms up exist
+    """
+    app.cli.add_command(schema_cli)
+    if app.config.get("WARMUP", False):
+        seconds = warm_up(app)
+        app.logger.info("warmed up in %.3f seconds", seconds)
@@ -0,0 +1,79 @@
+import threading
+
+from models import get_question_counts
+
+"""
+Question bank statistics
+
+The number of questions per category and difficulty is read from the
+question_counts table (see models.py), which the writes keep up to date,
+and cached in process until the data version changes. The totals of the
+question listings come from there too instead of a COUNT over the
+questions.
+"""
+
+
+class QuestionStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = None
+        self._data_version = None
+
+    def counts(self, data_version):
+        """
+        returns a dict of (category, difficulty) -> number of questions,
+        category and difficulty are 0 for questions without one
+        """
+        with self._lock:
+            if self._counts is not None and \
+                    data_version == self._data_version:
+                return self._counts
+
+        # read after the data version, so never older than it
+        counts = get_question_counts()
+        with self._lock:
+            self._counts = counts
+            self._data_version = data_version
+        return counts
+
+    def total(self, data_version, category=None):
+        """
+        returns the number of questions, of `category` if given
+        """
+        return sum(
+            count
+            for (key, _), count in self.counts(data_version).items()
+            if category is None or key == category
+        )
+
+    def summary(self, data_version, categories):
+        """
+        returns the body of GET /stats, `categories` is the id -> type
+        mapping of the category registry
+        """
+        by_category = {
+            key: {"type": type, "total_questions": 0, "difficulties": {}}
+            for key, type in categories.items()
+        }
+        by_difficulty = {}
+        total = 0
+        for (category, difficulty), count in \
+                sorted(self.counts(data_version).items()):
+            total += count
+            by_difficulty[difficulty] = \
+                by_difficulty.get(difficulty, 0) + count
+            entry = by_category.get(category)
+            if entry is not None:
+                entry["total_questions"] += count
+                entry["difficulties"][difficulty] = count
+        return {
+            "total_questions": total,
+            "categories": by_category,
+            "difficulties": by_difficulty,
+        }
+
+
+def init_app(app):
+    question_stats = QuestionStats()
+    app.extensions["question_stats"] = question_stats
+    return question_stats
@@ -0,0 +1,216 @@
+import atexit
+import queue
+import threading
+import time
+from http import HTTPStatus
+
+from flask import abort
+
+from models import db, Question
+
+"""
+Batched question writes
+
+With WRITE_BATCHING the question inserts and deletes of POST /questions and
+DELETE /questions/<id> are put on a bounded queue instead of being committed
+by the request. A background thread takes them off the queue and commits
+them in groups: it waits up to WRITE_FLUSH_INTERVAL seconds after the first
+write for more, at most WRITE_BATCH_SIZE per transaction, so a burst of
+submissions pays for one commit instead of one each.
+
+The request still waits until its write is committed before answering, a
+success response means the question is stored. If one write of a group
+fails (e.g. a category which does not exist) the group is rolled back and
+its writes are committed one by one, so only the bad one gets the error.
+
+When WRITE_QUEUE_SIZE writes are waiting, new ones wait up to
+WRITE_QUEUE_TIMEOUT seconds for room and are then answered 503 with a
+Retry-After header.
+
+The ASGI entry point keeps writing synchronously, its event loop must not
+block waiting for another thread.
+"""
+
+DEFAULT_BATCH_SIZE = 100
+# seconds
+DEFAULT_FLUSH_INTERVAL = 0.005
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_QUEUE_TIMEOUT = 1.0
+
+_STOP = object()
+
+
+class PendingWrite:
+    """
+    a write waiting on the queue, `apply` runs in the worker's session and
+    returns the result handed to the caller
+    """
+
+    def __init__(self, apply):
+        self.apply = apply
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class WriteQueue:
+    def __init__(self, app, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_size=DEFAULT_QUEUE_SIZE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.app = app
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_timeout = queue_timeout
+
+        self._queue = queue.Queue(max_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def insert(self, question):
+        """
+        commits the new `question` and returns its id
+        """
+
+        def apply():
+            db.session.add(question)
+            # the id is read after the group is flushed
+            return lambda: question.id
+
+        return self._submit(apply)
+
+    def delete(self, key):
+        """
+        deletes the question `key`, returns False if it does not exist
+        """
+
+        def apply():
+            question = Question.query.get(key)
+            if question is None:
+                return lambda: False
+            db.session.delete(question)
+            return lambda: True
+
+        return self._submit(apply)
+
+    def close(self):
+        """
+        commits the writes on the queue and stops the worker
+        """
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _submit(self, apply):
+        self._ensure_worker()
+        write = PendingWrite(apply)
+        try:
+            self._queue.put(write, timeout=self.queue_timeout)
+        except queue.Full:
+            abort(HTTPStatus.SERVICE_UNAVAILABLE,
+                  retry_after=max(1, round(self.queue_timeout)))
+        return write.wait()
+
+    def _ensure_worker(self):
+        # started on the first write, also in each process forked after
+        # the app was created
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="question-writes", daemon=True
+            )
+            self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    write = self._queue.get(
+                        timeout=max(0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if write is _STOP:
+                    stop = True
+                    break
+                batch.append(write)
+            with self.app.app_context():
+                try:
+                    self._commit(batch)
+                finally:
+                    db.session.remove()
+
+    def _commit(self, batch):
+        try:
+            results = [write.apply() for write in batch]
+            db.session.flush()
+            results = [result() for result in results]
+            db.session.commit()
+        except Exception as error:
+            db.session.rollback()
+            if len(batch) == 1:
+                batch[0].finish(error=error)
+                return
+        else:
+            for write, result in zip(batch, results):
+                write.finish(result)
+            return
+
+        # one bad write must not fail the others
+        for write in batch:
+            try:
+                result = write.apply()
+                db.session.flush()
+                result = result()
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                write.finish(error=error)
+            else:
+                write.finish(result)
+
+
+def init_app(app):
+    """
+    returns the write queue if WRITE_BATCHING is on, None otherwise
+    """
+    if not app.config.get("WRITE_BATCHING", False) or \
+            app.config.get("DB_ASYNC_DRIVER", False):
+        return None
+
+    write_queue = WriteQueue(
+        app,
+        batch_size=app.config.get("WRITE_BATCH_SIZE", DEFAULT_BATCH_SIZE),
+        flush_interval=app.config.get(
+            "WRITE_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL
+        ),
+        max_size=app.config.get("WRITE_QUEUE_SIZE", DEFAULT_QUEUE_SIZE),
+        queue_timeout=app.config.get(
+            "WRITE_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT
+        ),
+    )
+    app.extensions["write_queue"] = write_queue
+    # the writes still on the queue are committed before the process exits
+    atexit.register(write_queue.close)
+    return write_queue
@@ -0,0 +1,154 @@
+from sqlalchemy import (
+    Column, Integer, MetaData, Table, exists, inspect, select, text
+)
+from sqlalchemy.exc import DBAPIError
+
+"""
+Schema migrations
+
+setup_db calls upgrade() instead of a bare db.create_all(). Migrations run
+once, in order, in a single transaction and the number of the last one
+applied is kept in the schema_version table, so databases restored from
+trivia.psql and databases created from scratch end up with the same schema.
+
+Once the database is up to date, starting a process only costs reading
+schema_version, without taking the migration lock or inspecting tables.
+
+To change the schema, append a function to MIGRATIONS, never edit or
+reorder the ones that already shipped.
+"""
+
+version_metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    version_metadata,
+    Column("version", Integer, nullable=False),
+)
+
+
+def _create_tables(connection, metadata):
+    # skips tables which already exist, e.g. restored from trivia.psql
+    metadata.create_all(connection, checkfirst=True)
+
+
+def _create_query_indexes(connection, metadata):
+    # indexes declared on the models, see models.py
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def _create_fulltext_index(connection, metadata):
+    # used by the postgres search backend, the expression has to be the
+    # same as the one in flaskr/search.py
+    if connection.dialect.name != "postgresql":
+        return
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_fulltext ON questions "
+        "USING gin (to_tsvector('english', "
+        "coalesce(question, '') || ' ' || coalesce(answer, '')))"
+    ))
+
+
+def _create_data_version(connection, metadata):
+    table = metadata.tables["data_version"]
+    table.create(connection, checkfirst=True)
+    if connection.execute(select(table.c.id)).first() is None:
+        connection.execute(table.insert().values(id=1, version=0))
+
+
+def _create_question_counts(connection, metadata):
+    # imported here, models imports this module
+    from models import recount_questions
+
+    metadata.tables["question_counts"].create(connection, checkfirst=True)
+    recount_questions(connection)
+
+
+def _add_category_foreign_key(connection, metadata):
+    # create_all does not alter a questions table created before
+    # questions.category had a foreign key, one restored from trivia.psql
+    # has it already. sqlite cannot add a constraint to a table, older
+    # tables keep going without.
+    if connection.dialect.name != "postgresql":
+        return
+    if any(
+        key["constrained_columns"] == ["category"]
+        for key in inspect(connection).get_foreign_keys("questions")
+    ):
+        return
+
+    # imported here, models imports this module
+    from models import bump_data_version, recount_questions
+
+    questions = metadata.tables["questions"]
+    categories = metadata.tables["categories"]
+    # the questions of categories which do not exist lose their category,
+    # as if it had been deleted
+    orphans = connection.execute(
+        questions.update()
+        .where(questions.c.category.isnot(None))
+        .where(~exists().where(categories.c.id == questions.c.category))
+        .values(category=None)
+    ).rowcount
+    if orphans:
+        recount_questions(connection)
+        bump_data_version(connection)
+
+    connection.execute(text(
+        "ALTER TABLE questions ADD CONSTRAINT questions_category_fkey "
+        "FOREIGN KEY (category) REFERENCES categories (id) "
+        "ON UPDATE CASCADE ON DELETE SET NULL"
+    ))
+
+
+MIGRATIONS = [
+    _create_tables,
+    _create_query_indexes,
+    _create_fulltext_index,
+    _create_data_version,
+    _create_question_counts,
+    _add_category_foreign_key,
+]
+
+
+def current_version(connection):
+    schema_version.create(connection, checkfirst=True)
+    return connection.execute(select(schema_version.c.version)).scalar()
+
+
+def upgrade(engine, metadata):
+    """
+    applies the migrations the database has not seen yet,
+    returns the schema version
+    """
+    # the common case, nothing to do
+    with engine.connect() as connection:
+        try:
+            version = connection.execute(
+                select(schema_version.c.version)
+            ).scalar()
+        except DBAPIError:
+            # no schema_version table yet
+            version = None
+    if version == len(MIGRATIONS):
+        return version
+
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            # workers starting at the same time migrate one after another
+            connection.execute(text("SELECT pg_advisory_xact_lock(1962)"))
+
+        version = current_version(connection)
+        if version is None:
+            connection.execute(schema_version.insert().values(version=0))
+            version = 0
+
+        if version < len(MIGRATIONS):
+            for migration in MIGRATIONS[version:]:
+                migration(connection, metadata)
+            version = len(MIGRATIONS)
+            connection.execute(schema_version.update().values(version=version))
+
+    return version
@@ -1,7 +1,16 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
-import json
+from datetime import datetime
+from functools import wraps
+
+from sqlalchemy import Column, String, Integer, ForeignKey, Index
+from sqlalchemy import DateTime, Table, event, func, orm, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine.url import make_url
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from collections import Counter
+
+from migrations import upgrade
 
 database_dialect = "postgresql"
 database_name = "trivia"
@@ -10,21 +19,268 @@ database_password = "changeme"
 database_host = "localhost:5432"
 database_path = f"{database_dialect}://{database_username}:{database_password}@{database_host}/{database_name}"
 
+"""
+Engine settings
+
+Read from the flask config, or from environment variables of the same name.
+    DATABASE_URL            primary database, defaults to database_path
+    DATABASE_REPLICA_URL    optional read replica, see replica_reads
+    DB_POOL_SIZE            connections kept open per process
+    DB_MAX_OVERFLOW         extra connections opened under load
+    DB_POOL_TIMEOUT         seconds to wait for a connection from the pool
+    DB_POOL_RECYCLE         seconds after which a connection is replaced
+    DB_POOL_PRE_PING        test connections before using them (true/false)
+    DB_STATEMENT_TIMEOUT    postgres statement_timeout in milliseconds
+    DB_ASYNC_DRIVER         use the asyncio driver of the database, set by
+                            the ASGI entry point (see flaskr/asgi.py)
+    DB_ASYNC_FALLBACK       let code outside of a request run the asyncio
+                            driver synchronously, for tests
+    DB_SCHEMA_CHECK         when setup_db brings the schema up to date:
+                            once (default, the first time per process and
+                            database), always, or skip (run `flask schema
+                            upgrade` when deploying instead)
+
+The storage is picked by the database url:
+    postgresql://...        postgres, the default
+    sqlite:///path          a sqlite file, tuned by the settings below
+    sqlite://               an in-memory sqlite database held by the app's
+                            engine, lost on exit. See DATABASE_SEED in
+                            bulk.py
+
+    DB_SQLITE_JOURNAL_MODE  journal mode of sqlite files (default wal:
+                            readers do not block the writer)
+    DB_SQLITE_SYNCHRONOUS   sqlite synchronous pragma (default normal, which
+                            is durable with wal except on power loss)
+    DB_SQLITE_MMAP_SIZE     bytes of a sqlite file read through mmap
+                            (default 256 MiB)
+    DB_SQLITE_CACHE_SIZE    sqlite page cache in KiB (default 65536)
+    DB_SQLITE_STATEMENT_CACHE
+                            prepared statements kept per sqlite connection
+                            (default 256)
+"""
+
+POOL_SETTINGS = {
+    "DB_POOL_SIZE": ("pool_size", int),
+    "DB_MAX_OVERFLOW": ("max_overflow", int),
+    "DB_POOL_TIMEOUT": ("pool_timeout", int),
+    "DB_POOL_RECYCLE": ("pool_recycle", int),
+}
+
+
+# pragma -> (setting, default), the journal and mmap only apply to files
+SQLITE_PRAGMAS = {
+    "journal_mode": ("DB_SQLITE_JOURNAL_MODE", "wal"),
+    "synchronous": ("DB_SQLITE_SYNCHRONOUS", "normal"),
+    "mmap_size": ("DB_SQLITE_MMAP_SIZE", 256 * 1024 * 1024),
+    "cache_size": ("DB_SQLITE_CACHE_SIZE", 65536),
+}
+SQLITE_FILE_PRAGMAS = ("journal_mode", "mmap_size")
+DEFAULT_SQLITE_STATEMENT_CACHE = 256
+
+# asyncio drivers by backend, backends without one keep their driver
+ASYNC_DRIVERS = {
+    "postgresql": "asyncpg",
+}
+
+
+def _setting(app, name, default=None):
+    value = app.config.get(name)
+    if value is None:
+        value = os.environ.get(name, default)
+    return value
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def async_database_url(uri, fallback=False):
+    """
+    returns `uri` with the asyncio driver of its backend, with fallback
+    the driver also works when called outside of an event loop
+    """
+    url = make_url(uri)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        return url
+    url = url.set(drivername=f"{url.get_backend_name()}+{driver}")
+    if fallback:
+        url = url.update_query_dict({"async_fallback": "true"})
+    return url
+
+
+def engine_options(app, uri):
+    """
+    returns the create_engine keyword arguments for `uri`
+    """
+    options = {}
+    url = make_url(uri)
+    backend = url.get_backend_name()
+
+    # sqlite does not use a QueuePool, the pool settings do not apply
+    if backend != "sqlite":
+        for name, (option, cast) in POOL_SETTINGS.items():
+            value = _setting(app, name)
+            if value is not None:
+                options[option] = cast(value)
+
+    pre_ping = _setting(app, "DB_POOL_PRE_PING")
+    if pre_ping is not None:
+        options["pool_pre_ping"] = _as_bool(pre_ping)
+
+    statement_timeout = _setting(app, "DB_STATEMENT_TIMEOUT")
+    if statement_timeout is not None and backend == "postgresql":
+        if url.get_driver_name() == "asyncpg":
+            options["connect_args"] = {"server_settings": {
+                "statement_timeout": str(int(statement_timeout))
+            }}
+        else:
+            options["connect_args"] = {
+                "options": f"-c statement_timeout={int(statement_timeout)}"
+            }
+
+    if backend == "sqlite":
+        options["connect_args"] = {
+            "cached_statements": int(_setting(
+                app, "DB_SQLITE_STATEMENT_CACHE",
+                DEFAULT_SQLITE_STATEMENT_CACHE,
+            )),
+        }
+
+    return options
+
+
+def _in_memory(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == "sqlite" and \
+        url.database in (None, "", ":memory:")
+
+
+def sqlite_pragmas(app, uri):
+    """
+    returns the pragmas run on every new connection to the sqlite database
+    `uri`, the foreign keys are enforced like on postgres
+    """
+    in_memory = _in_memory(uri)
+    pragmas = {"foreign_keys": "on"}
+    for pragma, (name, default) in SQLITE_PRAGMAS.items():
+        if in_memory and pragma in SQLITE_FILE_PRAGMAS:
+            continue
+        pragmas[pragma] = _setting(app, name, default)
+    # a negative cache_size is in KiB, a positive one in pages
+    pragmas["cache_size"] = -abs(int(pragmas["cache_size"]))
+    return pragmas
 
-db = SQLAlchemy()
+
+"""
+Read replica routing
+
+Views decorated with replica_reads run their queries on the
+DATABASE_REPLICA_URL database if one is configured. Flushes, and so every
+insert, update and delete, always go to the primary.
+Replicas can lag behind, only use it for views which can show slightly
+stale data.
+"""
+
+
+def replica_reads(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_replica_reads = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if (
+            not self._flushing
+            and has_app_context()
+            and g.get("db_replica_reads", False)
+            and "replica" in (self.app.config.get("SQLALCHEMY_BINDS") or {})
+        ):
+            return db.get_engine(self.app, bind="replica")
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        sa_url, options = super().apply_driver_hacks(app, sa_url, options)
+        if _as_bool(app.config.get("DB_ASYNC_DRIVER", False)):
+            sa_url = async_database_url(
+                sa_url, _as_bool(app.config.get("DB_ASYNC_FALLBACK", False))
+            )
+        extra = engine_options(app, sa_url)
+        connect_args = dict(options.get("connect_args") or {})
+        connect_args.update(extra.pop("connect_args", {}))
+        options.update(extra)
+        if connect_args:
+            options["connect_args"] = connect_args
+        if sa_url.get_backend_name() == "sqlite":
+            options["sqlite_pragmas"] = sqlite_pragmas(app, sa_url)
+        return sa_url, options
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        engine = super().create_engine(sa_url, engine_opts)
+        if pragmas:
+            @event.listens_for(engine, "connect")
+            def set_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                for pragma, value in pragmas.items():
+                    cursor.execute(f"PRAGMA {pragma} = {value}")
+                cursor.close()
+        return engine
+
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    and brings the schema up to date, see migrations.py and
+    DB_SCHEMA_CHECK
+    the database is, in order: database_path, the DATABASE_URL setting,
+    or the default database_path above
 """
 
 
-def setup_db(app, database_path=database_path):
+# databases brought up to date by this process
+_upgraded = set()
+
+
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = app.config.get("SQLALCHEMY_DATABASE_URI") or \
+            _setting(app, "DATABASE_URL", globals()["database_path"])
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+    replica_path = _setting(app, "DATABASE_REPLICA_URL")
+    if replica_path:
+        binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+        binds["replica"] = replica_path
+        app.config["SQLALCHEMY_BINDS"] = binds
+
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+    schema_check = _setting(app, "DB_SCHEMA_CHECK", "once")
+    if schema_check == "always" or (
+        schema_check == "once" and database_path not in _upgraded
+    ):
+        upgrade(db.get_engine(app), db.metadata)
+        # every engine of an in-memory url is a new, empty database
+        if not _in_memory(database_path):
+            _upgraded.add(database_path)
+    elif schema_check not in ("once", "skip"):
+        raise ValueError(f"unknown DB_SCHEMA_CHECK {schema_check!r}")
 
 
 """
@@ -35,11 +291,20 @@ Question
 
 class Question(db.Model):
     __tablename__ = "questions"
+    __table_args__ = (
+        # questions of a category, paginated by id
+        Index("ix_questions_category_id", "category", "id"),
+        # quiz questions of a category and difficulty
+        Index("ix_questions_category_difficulty", "category", "difficulty"),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(Integer)
+    category = Column(
+        Integer,
+        ForeignKey("categories.id", onupdate="CASCADE", ondelete="SET NULL"),
+    )
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -79,10 +344,214 @@ class Category(db.Model):
     __tablename__ = "categories"
 
     id = Column(Integer, primary_key=True)
-    type = Column(String)
+    # categories are listed ordered by type
+    type = Column(String, index=True)
 
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
     def format(self):
         return {"id": self.id, "type": self.type}
+
+
+"""
+Data version
+
+A single row counter bumped in the same transaction as every insert, update
+and delete of a question or a category, so any process can tell whether
+the data changed with a primary key lookup. Used for HTTP caching and to
+refresh in-memory copies of the data.
+"""
+
+data_version = Table(
+    "data_version",
+    db.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("version", Integer, nullable=False, default=0),
+    # naive UTC
+    Column("updated_at", DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def bump_data_version(connection):
+    connection.execute(
+        data_version.update()
+        .where(data_version.c.id == 1)
+        .values(
+            version=data_version.c.version + 1,
+            updated_at=datetime.utcnow(),
+        )
+    )
+
+
+def get_data_version():
+    """
+    returns (version, updated_at)
+    """
+    row = db.session.execute(
+        select(data_version.c.version, data_version.c.updated_at)
+        .where(data_version.c.id == 1)
+    ).first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+
+@event.listens_for(Question, "after_insert")
+@event.listens_for(Question, "after_update")
+@event.listens_for(Question, "after_delete")
+@event.listens_for(Category, "after_insert")
+@event.listens_for(Category, "after_update")
+@event.listens_for(Category, "after_delete")
+def _bump_on_write(mapper, connection, target):
+    bump_data_version(connection)
+
+
+"""
+Question counts
+
+The number of questions of every (category, difficulty), kept up to date
+in the same transaction as the question writes so totals and statistics
+are a read of a few rows instead of a COUNT over the questions. Questions
+without a category or a difficulty are counted under 0.
+
+Writes through the ORM are counted when the session flushes, writes which
+bypass it call update_question_counts, or recount_questions when the rows
+written are not known (e.g. the questions of a deleted category lose it
+through the foreign key).
+"""
+
+question_counts = Table(
+    "question_counts",
+    db.metadata,
+    Column("category", Integer, primary_key=True),
+    Column("difficulty", Integer, primary_key=True),
+    Column("count", Integer, nullable=False),
+)
+
+_upserts = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def _count_key(category, difficulty):
+    return category or 0, difficulty or 0
+
+
+def update_question_counts(connection, deltas):
+    """
+    adds `deltas`, a dict of (category, difficulty) -> number of questions,
+    to the counts
+    """
+    upsert = _upserts.get(connection.dialect.name)
+    for (category, difficulty), delta in deltas.items():
+        if delta == 0:
+            continue
+        category, difficulty = _count_key(category, difficulty)
+        if upsert is not None:
+            statement = upsert(question_counts).values(
+                category=category, difficulty=difficulty, count=delta
+            )
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=["category", "difficulty"],
+                set_={"count": question_counts.c.count + delta},
+            ))
+            continue
+        updated = connection.execute(
+            question_counts.update()
+            .where(question_counts.c.category == category)
+            .where(question_counts.c.difficulty == difficulty)
+            .values(count=question_counts.c.count + delta)
+        ).rowcount
+        if updated == 0:
+            connection.execute(question_counts.insert().values(
+                category=category, difficulty=difficulty, count=delta
+            ))
+
+
+def recount_questions(connection):
+    questions = Question.__table__
+    category = func.coalesce(questions.c.category, 0)
+    difficulty = func.coalesce(questions.c.difficulty, 0)
+    rows = connection.execute(
+        select(category, difficulty, func.count())
+        .group_by(category, difficulty)
+    ).all()
+    connection.execute(question_counts.delete())
+    if rows:
+        connection.execute(question_counts.insert(), [
+            {"category": c, "difficulty": d, "count": n} for c, d, n in rows
+        ])
+
+
+def get_question_counts():
+    """
+    returns a dict of (category, difficulty) -> number of questions
+    """
+    rows = db.session.execute(select(
+        question_counts.c.category,
+        question_counts.c.difficulty,
+        question_counts.c.count,
+    ).where(question_counts.c.count != 0))
+    return {(c, d): n for c, d, n in rows}
+
+
+def _count_delta(target, category, difficulty, delta):
+    session = orm.object_session(target)
+    if session is not None:
+        deltas = session.info.setdefault("question_count_deltas", Counter())
+        deltas[_count_key(category, difficulty)] += delta
+
+
+@event.listens_for(Question, "after_insert")
+def _count_insert(mapper, connection, target):
+    _count_delta(target, target.category, target.difficulty, 1)
+
+
+@event.listens_for(Question, "after_delete")
+def _count_delete(mapper, connection, target):
+    _count_delta(target, target.category, target.difficulty, -1)
+
+
+@event.listens_for(Question, "after_update")
+def _count_update(mapper, connection, target):
+    # the values before this flush
+    state = orm.attributes.instance_state(target)
+    category, difficulty = (
+        state.attrs[name].history.deleted[:1] or [getattr(target, name)]
+        for name in ("category", "difficulty")
+    )
+    _count_delta(target, category[0], difficulty[0], -1)
+    _count_delta(target, target.category, target.difficulty, 1)
+
+
+@event.listens_for(Category, "after_update")
+@event.listens_for(Category, "after_delete")
+def _recount_on_category_write(mapper, connection, target):
+    # the foreign key moved the questions of the category
+    session = orm.object_session(target)
+    if session is not None:
+        session.info["recount_questions"] = True
+
+
+# one statement per (category, difficulty) written in the flush
+@event.listens_for(db.session, "after_flush")
+def _apply_count_deltas(session, flush_context):
+    deltas = session.info.pop("question_count_deltas", None)
+    connection = session.connection()
+    if session.info.pop("recount_questions", False):
+        recount_questions(connection)
+    elif deltas:
+        update_question_counts(connection, deltas)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_count_deltas(session):
+    session.info.pop("question_count_deltas", None)
+    session.info.pop("recount_questions", None)
@@ -1,10 +1,37 @@
+import gzip
+import json
+import os
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
 
 from flask_sqlalchemy import SQLAlchemy
 
-from flaskr import create_app, QUESTIONS_PER_PAGE
-from models import setup_db
+from flaskr import (
+    create_app, bulk, quiz, ratelimit, search, QUESTIONS_PER_PAGE,
+)
+from flaskr.asgi import create_asgi_app
+from models import (
+    db, setup_db, async_database_url, bump_data_version, engine_options,
+    get_data_version, sqlite_pragmas, Category, Question,
+)
+
+# TRIVIA_TEST_ASGI=1 runs the tests against the ASGI entry point
+TEST_ASGI = os.environ.get("TRIVIA_TEST_ASGI", "") not in ("", "0")
+# the test database, e.g. sqlite:////tmp/trivia_test.db to run the tests
+# without postgres. An empty database is filled from trivia.psql
+TEST_DATABASE_URL = os.environ.get("TRIVIA_TEST_DATABASE_URL")
+# sqlite:// is a new, empty database for every engine, apps can not share it
+TEST_IN_MEMORY = TEST_DATABASE_URL == "sqlite://"
+TEST_SEED = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "trivia.psql")
+
+try:
+    import fcntl
+except ImportError:
+    # the shared quiz index locks its file with fcntl, not on windows
+    fcntl = None
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -12,16 +39,29 @@ class TriviaTestCase(unittest.TestCase):
 
     def setUp(self):
         """Define test variables and initialize app."""
-        self.app = create_app()
-        self.client = self.app.test_client
         database_dialect = "postgresql"
         database_name = "trivia_test"
         database_username = "postgres"
         database_password = "changeme"
         database_host = "localhost:5432"
-        self.database_path = f"{database_dialect}://" + \
+        self.postgres_path = f"{database_dialect}://" + \
             f"{database_username}:{database_password}" + \
             f"@{database_host}/{database_name}"
+        self.database_path = TEST_DATABASE_URL or self.postgres_path
+        config = {
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+            "DATABASE_SEED": TEST_SEED,
+        }
+        if TEST_ASGI:
+            asgi_app = create_asgi_app(dict(config, DB_ASYNC_FALLBACK=True))
+            self.app = asgi_app.start()
+            self.client = asgi_app.test_client
+        else:
+            self.app = create_app(config)
+            self.client = self.app.test_client
+        if TEST_IN_MEMORY:
+            # binding the app again would replace its seeded database
+            return
         setup_db(self.app, self.database_path)
 
         # binds the app to the current context
@@ -35,6 +75,50 @@ class TriviaTestCase(unittest.TestCase):
         """Executed after reach test"""
         pass
 
+    # engine settings are read from the config
+    def test_engine_options(self):
+        self.app.config.update({
+            "DB_POOL_SIZE": "5",
+            "DB_POOL_RECYCLE": 300,
+            "DB_POOL_PRE_PING": "true",
+            "DB_STATEMENT_TIMEOUT": 2000,
+        })
+        options = engine_options(self.app, self.postgres_path)
+        self.assertEqual(options.get("pool_size"), 5)
+        self.assertEqual(options.get("pool_recycle"), 300)
+        self.assertTrue(options.get("pool_pre_ping"))
+        self.assertEqual(options.get("connect_args"),
+                         {"options": "-c statement_timeout=2000"})
+
+    # the ASGI entry point uses the asyncio driver
+    def test_async_database_url(self):
+        url = async_database_url(self.postgres_path, fallback=True)
+        self.assertEqual(url.drivername, "postgresql+asyncpg")
+        self.assertEqual(url.query.get("async_fallback"), "true")
+        self.assertEqual(url.database, "trivia_test")
+
+    # sqlite files are tuned, in-memory databases skip the file pragmas
+    def test_sqlite_pragmas(self):
+        self.app.config["DB_SQLITE_CACHE_SIZE"] = "1024"
+        pragmas = sqlite_pragmas(self.app, "sqlite:////tmp/trivia.db")
+        self.assertEqual(pragmas.get("journal_mode"), "wal")
+        self.assertEqual(pragmas.get("cache_size"), -1024)
+        self.assertEqual(pragmas.get("foreign_keys"), "on")
+        pragmas = sqlite_pragmas(self.app, "sqlite://")
+        self.assertNotIn("journal_mode", pragmas)
+        self.assertNotIn("mmap_size", pragmas)
+
+    # every in-memory database is migrated, not only the first one
+    def test_in_memory_databases(self):
+        for _ in range(2):
+            memory_app = create_app({
+                "SQLALCHEMY_DATABASE_URI": "sqlite://",
+                "DATABASE_SEED": TEST_SEED,
+            })
+            res = memory_app.test_client().get("/questions")
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            self.assertGreater(res.get_json().get("total_questions"), 0)
+
     # tests for /categories
     # no tests where this route should fail
     def test_working_get_categories(self):
@@ -44,6 +128,27 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(json_data.get("categories"))
         self.assertGreater(len(json_data.get("categories")), 0)
 
+    # cached categories are refreshed once a category is committed
+    def test_get_categories_after_insert(self):
+        self.client().get("/categories")
+
+        with self.app.app_context():
+            category = Category(type="Example category")
+            category.insert()
+            key = category.id
+
+        res = self.client().get("/categories")
+        json_data = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(json_data.get("categories").get(str(key)),
+                         "Example category")
+
+        with self.app.app_context():
+            Category.query.get(key).delete()
+
+        res = self.client().get("/categories")
+        self.assertNotIn(str(key), res.get_json().get("categories"))
+
     # tests for /questions GET
     def test_working_get_questions_no_page(self):
         res = self.client().get("/questions")
@@ -90,6 +195,196 @@ class TriviaTestCase(unittest.TestCase):
         self.assertFalse(json_data.get("questions"))
         self.assertFalse(json_data.get("categories"))
 
+    # keyset pagination visits every question exactly once
+    def test_working_get_questions_after_id(self):
+        num_questions = self.client().get("/questions") \
+            .get_json().get("total_questions")
+
+        seen = []
+        after_id = 0
+        while after_id is not None:
+            res = self.client().get("/questions",
+                                    query_string={"after_id": after_id})
+            json_data = res.get_json()
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            self.assertLessEqual(len(json_data.get("questions")),
+                                 QUESTIONS_PER_PAGE)
+            seen += [q.get("id") for q in json_data.get("questions")]
+            after_id = json_data.get("next_after_id")
+
+        self.assertEqual(len(seen), num_questions)
+        self.assertEqual(seen, sorted(set(seen)))
+
+    # cursors neither skip nor repeat questions when others are written
+    # between two pages
+    def test_cursor_pagination_with_writes(self):
+        res = self.client().get("/questions")
+        json_data = res.get_json()
+        seen = [q.get("id") for q in json_data.get("questions")]
+        category = list(json_data.get("categories"))[0]
+        cursor = json_data.get("next_cursor")
+        self.assertTrue(cursor)
+
+        # a question already listed goes away, a new one comes at the end
+        self.client().delete(f"/questions/{seen[0]}")
+        self.client().post("/questions", json={
+            "question": "Which question is added while paging?",
+            "answer": "This one",
+            "difficulty": 2,
+            "category": category,
+        })
+        expected = seen[1:]
+        after_id = 0
+        while after_id is not None:
+            page = self.client().get(
+                "/questions", query_string={"after_id": after_id}
+            ).get_json()
+            expected += [q.get("id") for q in page.get("questions")
+                         if q.get("id") > seen[-1]]
+            after_id = page.get("next_after_id")
+
+        while cursor is not None:
+            res = self.client().get("/questions",
+                                    query_string={"cursor": cursor})
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            json_data = res.get_json()
+            seen += [q.get("id") for q in json_data.get("questions")]
+            cursor = json_data.get("next_cursor")
+        self.assertEqual(seen[1:], expected)
+
+    # search results can be paged with cursors too
+    def test_search_cursor(self):
+        body = {"searchTerm": ""}
+        json_data = self.client().post("/questions/search", json=body) \
+            .get_json()
+        total = json_data.get("total_questions")
+        seen = [q.get("id") for q in json_data.get("questions")]
+        while json_data.get("next_cursor"):
+            body["cursor"] = json_data.get("next_cursor")
+            res = self.client().post("/questions/search", json=body)
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            json_data = res.get_json()
+            seen += [q.get("id") for q in json_data.get("questions")]
+        self.assertEqual(len(seen), total)
+        self.assertEqual(len(set(seen)), total)
+
+    # cursors stop at the result cap of either backend, the postgres one
+    # needs full-text search for a term only
+    def test_search_cursor_cap(self):
+        cap = 15
+        for backend in (search.MemorySearchBackend(cap=cap),
+                        search.PostgresSearchBackend(cap=cap)):
+            with self.app.app_context():
+                seen, total, after = backend.search("", 0, 10)
+                while after is not None:
+                    ids, total, after = backend.search("", 0, 10, after)
+                    seen += ids
+            self.assertEqual(total, cap)
+            self.assertEqual(len(seen), cap)
+            self.assertEqual(len(set(seen)), cap)
+
+    def test_invalid_cursor(self):
+        res = self.client().get("/questions",
+                                query_string={"cursor": "not a cursor"})
+        self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+        res = self.client().post("/questions/search",
+                                 json={"searchTerm": "", "cursor": "WzFd"})
+        self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+
+    # after_id past the last question should produce a NOT_FOUND 404 error
+    def test_out_of_bounds_after_id_questions(self):
+        res = self.client().get("/questions",
+                                query_string={"after_id": 999999})
+        json_data = res.get_json()
+
+        self.assertEqual(res.status_code, HTTPStatus.NOT_FOUND)
+        self.assertFalse(json_data.get("success"))
+
+    # conditional GET with the ETag of the last response
+    def test_get_questions_not_modified(self):
+        res = self.client().get("/questions")
+        etag = res.headers.get("ETag")
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertTrue(etag)
+
+        res = self.client().get("/questions",
+                                headers={"If-None-Match": etag})
+        self.assertEqual(res.status_code, HTTPStatus.NOT_MODIFIED)
+        self.assertEqual(res.get_data(), b"")
+
+    # adding a question changes the ETag
+    def test_get_questions_modified(self):
+        res = self.client().get("/categories")
+        etag = res.headers.get("ETag")
+        category = list(res.get_json().get("categories"))[0]
+
+        question = {
+            "question": "Example question text",
+            "answer": "YES!",
+            "difficulty": 1,
+            "category": category,
+        }
+        self.client().post("/questions", json=question)
+
+        for url in ["/categories", "/questions",
+                    f"/categories/{category}/questions"]:
+            res = self.client().get(url, headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            self.assertNotEqual(res.headers.get("ETag"), etag)
+
+    # large responses are gzipped if the client accepts it
+    def test_get_questions_compressed(self):
+        plain = self.client().get("/questions")
+        res = self.client().get("/questions",
+                                headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(res.headers.get("Content-Encoding"), "gzip")
+        self.assertIn("Accept-Encoding", res.headers.get("Vary"))
+        self.assertEqual(json.loads(gzip.decompress(res.get_data())),
+                         plain.get_json())
+
+    # the counts follow the writes and match the listings
+    def test_get_stats(self):
+        res = self.client().get("/stats")
+        stats = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        total = self.client().get("/questions").get_json() \
+            .get("total_questions")
+        self.assertEqual(stats.get("total_questions"), total)
+        self.assertEqual(sum(stats.get("difficulties").values()), total)
+
+        category = list(stats.get("categories"))[0]
+        before = stats["categories"][category]
+        question = {
+            "question": "Which question is counted?",
+            "answer": "This one",
+            "difficulty": 5,
+            "category": category,
+        }
+        self.client().post("/questions", json=question)
+        after = self.client().get("/stats").get_json() \
+            .get("categories")[category]
+        self.assertEqual(after["total_questions"],
+                         before["total_questions"] + 1)
+        self.assertEqual(after["difficulties"].get("5"),
+                         before["difficulties"].get("5", 0) + 1)
+        res = self.client().get(f"/categories/{category}/questions")
+        self.assertEqual(res.get_json().get("total_questions"),
+                         after["total_questions"])
+
+    # requests and their SQL statements are reported on /metrics
+    def test_get_metrics(self):
+        self.client().get("/questions")
+        res = self.client().get("/metrics")
+        body = res.get_data(as_text=True)
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertTrue(res.content_type.startswith("text/plain"))
+        self.assertIn('trivia_http_requests_total{route="/questions",'
+                      'method="GET",status="200"} 1', body)
+        self.assertIn('trivia_http_request_duration_seconds_count'
+                      '{route="/questions",method="GET"} 1', body)
+        self.assertIn('trivia_db_queries_total{route="/questions"}', body)
+
     # tests for questions delete request
     def test_successful_delete(self):
         # get a single question from db
@@ -130,6 +425,49 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, HTTPStatus.OK)
         self.assertTrue(res.get_json().get("success"))
 
+    # with write batching concurrent writes are committed together
+    @unittest.skipIf(TEST_IN_MEMORY, "needs a database shared by apps")
+    def test_write_batching(self):
+        batching_app = create_app({
+            "WRITE_BATCHING": True,
+            "WRITE_FLUSH_INTERVAL": 0.05,
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+        })
+        client = batching_app.test_client
+        res = client().get("/questions")
+        num_questions = res.get_json().get("total_questions")
+        category = list(res.get_json().get("categories"))[0]
+        question = {
+            "question": "Which batch holds this question?",
+            "answer": "The next one",
+            "difficulty": 1,
+            "category": category,
+        }
+
+        with ThreadPoolExecutor(4) as executor:
+            statuses = list(executor.map(
+                lambda _: client().post("/questions", json=question)
+                .status_code,
+                range(4),
+            ))
+        self.assertEqual(statuses, [HTTPStatus.OK] * 4)
+        res = client().post("/questions/search",
+                            json={"searchTerm": "which batch holds"})
+        keys = [q["id"] for q in res.get_json().get("questions")]
+        self.assertEqual(len(keys), 4)
+        self.assertEqual(client().get("/questions")
+                         .get_json().get("total_questions"),
+                         num_questions + 4)
+
+        for key in keys:
+            res = client().delete(f"/questions/{key}")
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+        res = client().delete(f"/questions/{keys[0]}")
+        self.assertEqual(res.status_code, HTTPStatus.NOT_FOUND)
+        res = client().post("/questions", json=dict(question, category=1000))
+        self.assertEqual(res.status_code, HTTPStatus.UNPROCESSABLE_ENTITY)
+        batching_app.extensions["write_queue"].close()
+
     # this request fails due to a missing required field
     def test_unsuccessful_post_question(self):
         # category is a missing field
@@ -146,6 +484,112 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(json.get("message"), HTTPStatus.BAD_REQUEST.phrase)
         self.assertFalse(json.get("success"))
 
+    # a category which does not exist is refused by the foreign key
+    @unittest.skipIf(TEST_IN_MEMORY, "needs a database shared by apps")
+    def test_post_question_unknown_category(self):
+        # setUp binds a plain SQLAlchemy, without the sqlite pragmas
+        client = create_app({
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+        }).test_client
+        question = {
+            "question": "Which category is this in?",
+            "answer": "None",
+            "difficulty": 1,
+            "category": 1000,
+        }
+        res = client().post("/questions", json=question)
+        self.assertEqual(res.status_code, HTTPStatus.UNPROCESSABLE_ENTITY)
+        self.assertFalse(res.get_json().get("success"))
+
+        # the session is usable again
+        res = client().post("/questions", json=dict(question, category=1))
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+
+    # the form sends numbers as strings, the quiz index gets the ints
+    def test_post_question_string_fields(self):
+        question = {
+            "question": "Which string became a number?",
+            "answer": "This one",
+            "difficulty": "1",
+            "category": "1",
+        }
+        res = self.client().post("/questions", json=question)
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        with self.app.app_context():
+            key = Question.query.order_by(Question.id.desc()).first().id
+            self.assertIn(key, self.app.extensions["question_index"]
+                          .candidates(1, 1))
+
+        for invalid in ({"difficulty": "easy"}, {"category": 1.7},
+                        {"category": True}, {"difficulty": "1.5"}):
+            res = self.client().post("/questions",
+                                     json=dict(question, **invalid))
+            self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+
+    # bulk import of questions as JSON Lines
+    def test_successful_bulk_import(self):
+        setup_res = self.client().get("/questions")
+        json_data = setup_res.get_json()
+        num_questions = json_data.get("total_questions")
+        category = int(list(json_data.get("categories"))[0])
+
+        lines = "".join(
+            f'{{"question": "Bulk question {i}", "answer": "YES!", '
+            f'"difficulty": 1, "category": {category}}}\n'
+            for i in range(5)
+        )
+        res = self.client().post("/questions/bulk", data=lines,
+                                 query_string={"chunk_size": 2},
+                                 content_type="application/x-ndjson")
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertTrue(json.get("success"))
+        self.assertEqual(json.get("inserted"), 5)
+
+        res = self.client().get("/questions")
+        self.assertEqual(res.get_json().get("total_questions"),
+                         num_questions + 5)
+
+    # an invalid line fails the whole import
+    def test_unsuccessful_bulk_import(self):
+        num_questions = self.client().get("/questions") \
+            .get_json().get("total_questions")
+
+        lines = '{"question": "Bulk question", "answer": "YES!", ' \
+            '"difficulty": 1, "category": 1}\n' \
+            '{"question": "Bulk question", "answer": "YES!"}\n'
+        res = self.client().post("/questions/bulk", data=lines,
+                                 content_type="application/x-ndjson")
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.UNPROCESSABLE_ENTITY)
+        self.assertFalse(json.get("success"))
+        self.assertEqual(json.get("line"), 2)
+
+        res = self.client().get("/questions")
+        self.assertEqual(res.get_json().get("total_questions"),
+                         num_questions)
+
+    # export holds one line per question
+    def test_bulk_export(self):
+        num_questions = self.client().get("/questions") \
+            .get_json().get("total_questions")
+
+        res = self.client().get("/questions/export")
+        lines = res.get_data(as_text=True).splitlines()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(len(lines), num_questions)
+
+    # the seed dump is read without psql
+    def test_parse_dump(self):
+        with open(TEST_SEED) as dump:
+            tables = bulk.parse_dump(dump)
+        self.assertEqual(len(tables["categories"]), 6)
+        self.assertTrue(tables["questions"])
+        question = tables["questions"][0]
+        self.assertEqual(set(question),
+                         {"id", "question", "answer", "difficulty",
+                          "category"})
+
     # test search questions functionality
     def test_search_functionality(self):
         body = {"searchTerm": "what"}
@@ -155,6 +599,82 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(json.get("questions"))
         self.assertTrue(json.get("total_questions"))
 
+    # search results are ranked, the best match comes first
+    def test_search_ranking(self):
+        question = {
+            "question": "Which zebrafish example question ranks first?",
+            "answer": "This one",
+            "difficulty": 1,
+            "category": 1,
+        }
+        self.client().post("/questions", json=question)
+
+        body = {"searchTerm": "zebrafish"}
+        res = self.client().post("/questions/search", json=body)
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(json.get("questions")[0].get("question"),
+                         question.get("question"))
+
+    def test_search_no_results(self):
+        body = {"searchTerm": "xqzxqzxqz"}
+        res = self.client().post("/questions/search", json=body)
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(json.get("questions"), [])
+        self.assertEqual(json.get("total_questions"), 0)
+
+    # search page past the last result should produce a 404 error
+    def test_out_of_bounds_page_search(self):
+        body = {"searchTerm": "what", "page": 1000}
+        res = self.client().post("/questions/search", json=body)
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.NOT_FOUND)
+        self.assertFalse(json.get("success"))
+
+    # a client past its search rate limit gets a 429 error
+    def test_search_rate_limited(self):
+        limiter = self.app.extensions["rate_limiter"]
+        limiter.limits["search_questions"] = (0.01, 1)
+        body = {"searchTerm": "what"}
+        self.client().post("/questions/search", json=body)
+        res = self.client().post("/questions/search", json=body)
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertFalse(json.get("success"))
+        self.assertGreater(int(res.headers.get("Retry-After")), 0)
+
+    # behind a trusted proxy each forwarded client gets its own bucket
+    def test_rate_limit_behind_proxy(self):
+        self.app.config.update({
+            "TRUSTED_PROXIES": 1,
+            "RATE_LIMITS": {"search_questions": (0.01, 1)},
+        })
+        ratelimit.init_app(self.app)
+        body = {"searchTerm": "what"}
+        statuses = [
+            self.client().post(
+                "/questions/search", json=body,
+                headers={"X-Forwarded-For": client},
+            ).status_code
+            for client in ("192.0.2.1", "192.0.2.2", "192.0.2.1")
+        ]
+        self.assertEqual(statuses, [HTTPStatus.OK, HTTPStatus.OK,
+                                    HTTPStatus.TOO_MANY_REQUESTS])
+
+    # requests over the concurrency cap are shed with a 503 error
+    def test_search_over_concurrency_cap(self):
+        limiter = ratelimit.RateLimiter(
+            ratelimit.MemoryRateLimitBackend(), {}, max_concurrent=1
+        )
+        self.app.extensions["rate_limiter"] = limiter
+        with limiter.admitted():
+            res = self.client().post("/questions/search",
+                                     json={"searchTerm": "what"})
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+        self.assertFalse(json.get("success"))
+
     # test getting questions for a specific category
     def test_get_category_questions(self):
         setup_res = self.client().get("/questions")
@@ -169,6 +689,31 @@ class TriviaTestCase(unittest.TestCase):
         self.assertGreater(len(questions), 0)
         self.assertGreater(json.get("total_questions"), 0)
 
+    # the streamed body holds every question of the category
+    def test_get_category_questions_stream(self):
+        setup_res = self.client().get("/questions")
+        json_data = setup_res.get_json()
+        category = list(json_data.get("categories"))[0]
+        res = self.client().get(f"categories/{category}/questions",
+                                query_string={"stream": "true"})
+        json = res.get_json()
+        questions = json.get("questions")
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(len(questions), json.get("total_questions"))
+        self.assertEqual(json.get("current_category"), int(category))
+        for q in questions:
+            self.assertEqual(q.get("category"), int(category))
+
+    def test_out_of_bounds_page_category_questions(self):
+        setup_res = self.client().get("/questions")
+        json_data = setup_res.get_json()
+        category = list(json_data.get("categories"))[0]
+        res = self.client().get(f"categories/{category}/questions",
+                                query_string={"page": 1000})
+        json = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.NOT_FOUND)
+        self.assertFalse(json.get("success"))
+
     # test getting questions for unknown category
     def test_get_unknown_category_questions(self):
         category = 9999
@@ -235,6 +780,302 @@ class TriviaTestCase(unittest.TestCase):
             else:
                 self.assertFalse(json_res.get("question"))
 
+    # same as the quiz tests but the server keeps track of the questions
+    def test_quiz_session(self):
+        setup_res = self.client().get("/questions")
+        json_data = setup_res.get_json()
+        category_id = list(json_data.get("categories"))[0]
+        res = self.client().get(f"categories/{category_id}/questions")
+        num_questions = int(res.get_json().get("total_questions"))
+
+        data = {"session": True, "quiz_category": {"id": category_id}}
+        res = self.client().post("/quizzes", json=data)
+        json_res = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        quiz_id = json_res.get("quiz_id")
+        self.assertTrue(quiz_id)
+
+        asked = []
+        question = json_res.get("question")
+        while question is not None:
+            self.assertEqual(question.get("category"), int(category_id))
+            asked.append(question.get("id"))
+            res = self.client().post("/quizzes", json={"quiz_id": quiz_id})
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            question = res.get_json().get("question")
+
+        self.assertEqual(len(asked), num_questions)
+        self.assertEqual(len(set(asked)), num_questions)
+
+    def test_quiz_unknown_session(self):
+        res = self.client().post("/quizzes", json={"quiz_id": "unknown"})
+        json_res = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.NOT_FOUND)
+        self.assertFalse(json_res.get("success"))
+        res = self.client().post("/quizzes", json={"quiz_id": [1]})
+        self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+
+    # a category id which is not a number is a bad request
+    def test_quiz_invalid_category(self):
+        data = {"previous_questions": [], "quiz_category": {"id": "abc"}}
+        res = self.client().post("/quizzes", json=data)
+        json_res = res.get_json()
+        self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(json_res.get("success"))
+
+    # "count" returns several distinct questions per request
+    def test_quiz_batch(self):
+        num_questions = self.client().get("/questions").get_json() \
+            .get("total_questions")
+        previous_questions = []
+        while True:
+            data = {"previous_questions": previous_questions, "count": 5}
+            res = self.client().post("/quizzes", json=data)
+            questions = res.get_json().get("questions")
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            if not questions:
+                break
+            self.assertLessEqual(len(questions), 5)
+            previous_questions += [q.get("id") for q in questions]
+        self.assertEqual(len(previous_questions), num_questions)
+        self.assertEqual(len(set(previous_questions)), num_questions)
+
+    def test_quiz_session_batch(self):
+        data = {"previous_questions": [], "session": True, "count": 3}
+        res = self.client().post("/quizzes", json=data)
+        json_res = res.get_json()
+        first = [q.get("id") for q in json_res.get("questions")]
+        self.assertEqual(len(first), 3)
+
+        data = {"quiz_id": json_res.get("quiz_id"), "count": 3}
+        res = self.client().post("/quizzes", json=data)
+        second = [q.get("id") for q in res.get_json().get("questions")]
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(len(second), 3)
+        self.assertFalse(set(first) & set(second))
+
+    def test_quiz_invalid_count(self):
+        for count in (0, "5", True):
+            data = {"previous_questions": [], "count": count}
+            res = self.client().post("/quizzes", json=data)
+            self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+
+    # only questions of the requested difficulty are asked
+    def test_quiz_with_difficulty(self):
+        with self.app.app_context():
+            num_questions = Question.query.filter_by(difficulty=1).count()
+        previous_questions = []
+        for i in range(num_questions + 1):
+            data = {"previous_questions": previous_questions,
+                    "difficulty": 1}
+            res = self.client().post("/quizzes", json=data)
+            question = res.get_json().get("question")
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            if i < num_questions:
+                self.assertEqual(question.get("difficulty"), 1)
+                previous_questions.append(question.get("id"))
+            else:
+                self.assertIsNone(question)
+
+    # wrong answers make the next question easier
+    def test_quiz_adaptive(self):
+        with self.app.app_context():
+            easiest = min(
+                difficulty for difficulty, in
+                Question.query.with_entities(Question.difficulty).distinct()
+            )
+        data = {"previous_questions": [], "adaptive": True,
+                "answers": [False] * 5}
+        res = self.client().post("/quizzes", json=data)
+        question = res.get_json().get("question")
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(question.get("difficulty"), easiest)
+
+    # questions written by another process are picked up once the data
+    # version changed, the writes of this one do not rebuild the index
+    def test_quiz_index_data_version(self):
+        self.app.config["QUIZ_INDEX_POLL_INTERVAL"] = 0
+        index = quiz.init_app(self.app)
+        with self.app.app_context():
+            index.load()
+            loaded_at = index._loaded_at
+            question = Question("Which process wrote this?", "Another one",
+                                1, 1)
+            question.insert()
+            index.load()
+            self.assertEqual(index._loaded_at, loaded_at)
+            self.assertEqual(index._data_version, get_data_version()[0])
+            question.delete()
+
+            # written without the ORM, like another process would
+            with db.engine.begin() as connection:
+                key = connection.execute(Question.__table__.insert(), {
+                    "question": "Which process wrote this?",
+                    "answer": "Another one",
+                    "category": 1,
+                    "difficulty": 1,
+                }).inserted_primary_key[0]
+                bump_data_version(connection)
+            self.assertIn(key, index.candidates(1, 1))
+            with db.engine.begin() as connection:
+                connection.execute(Question.__table__.delete()
+                                   .where(Question.id == key))
+                bump_data_version(connection)
+            self.assertNotIn(key, index.candidates(1, 1))
+
+    def test_search_index_data_version(self):
+        self.app.config["SEARCH_INDEX_POLL_INTERVAL"] = 0
+        backend = search.init_app(self.app)
+        with self.app.app_context():
+            backend.load()
+            loaded_at = backend._loaded_at
+            question = Question("Which process wrote this?", "Another one",
+                                1, 1)
+            question.insert()
+            backend.load()
+            self.assertEqual(backend._loaded_at, loaded_at)
+            self.assertEqual(backend._data_version, get_data_version()[0])
+            question.delete()
+
+            # written without the ORM, like another process would
+            with db.engine.begin() as connection:
+                key = connection.execute(Question.__table__.insert(), {
+                    "question": "Which process wrote this?",
+                    "answer": "Another one",
+                    "category": 1,
+                    "difficulty": 1,
+                }).inserted_primary_key[0]
+                bump_data_version(connection)
+            self.assertIn(key, backend.search("which process", 0, 10)[0])
+            with db.engine.begin() as connection:
+                connection.execute(Question.__table__.delete()
+                                   .where(Question.id == key))
+                bump_data_version(connection)
+            self.assertNotIn(key, backend.search("which process", 0, 10)[0])
+
+    def test_quiz_adaptive_invalid_answers(self):
+        data = {"previous_questions": [], "adaptive": True,
+                "answers": ["yes"]}
+        res = self.client().post("/quizzes", json=data)
+        self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+        self.assertFalse(res.get_json().get("success"))
+
+        # sessions cannot be adaptive
+        for data in ({"adaptive": True, "session": True},
+                     {"adaptive": True, "quiz_id": "unknown"}):
+            res = self.client().post("/quizzes", json=data)
+            self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+
+    # a starting difficulty of 0 is kept, the nearest one is used
+    def test_quiz_adaptive_start_zero(self):
+        data = {"previous_questions": [], "adaptive": True, "answers": [],
+                "difficulty": 0}
+        res = self.client().post("/quizzes", json=data)
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertEqual(res.get_json()["question"]["difficulty"], 1)
+
+    # the snapshot serves the same responses as the db
+    @unittest.skipIf(TEST_IN_MEMORY, "needs a database shared by apps")
+    def test_snapshot_mode(self):
+        snapshot_app = create_app({
+            "SNAPSHOT_MODE": True,
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+        })
+        snapshot_client = snapshot_app.test_client()
+
+        category = list(self.client().get("/categories")
+                        .get_json().get("categories"))[0]
+        for url in ["/questions", f"/categories/{category}/questions"]:
+            res = self.client().get(url)
+            snapshot_res = snapshot_client.get(url)
+            self.assertEqual(snapshot_res.status_code, HTTPStatus.OK)
+            self.assertEqual(snapshot_res.get_json(), res.get_json())
+
+        res = snapshot_client.post("/quizzes",
+                                   json={"previous_questions": []})
+        self.assertEqual(res.status_code, HTTPStatus.OK)
+        self.assertTrue(res.get_json().get("question"))
+
+    # with WARMUP the caches are loaded before the first request
+    @unittest.skipIf(TEST_IN_MEMORY, "needs a database shared by apps")
+    def test_warmup(self):
+        warm_app = create_app({
+            "WARMUP": True,
+            "QUIZ_INDEX_PRELOAD": False,
+            "DB_SCHEMA_CHECK": "skip",
+            "SQLALCHEMY_DATABASE_URI": self.database_path,
+        })
+        registry = warm_app.extensions["category_registry"]
+        self.assertFalse(registry._expired(None))
+        self.assertFalse(warm_app.extensions["question_index"]._expired())
+        res = warm_app.test_client().get("/categories")
+        self.assertEqual(len(res.get_json().get("categories")),
+                         len(registry.categories()))
+
+    # workers map one index file, built by the first of them
+    @unittest.skipIf(TEST_IN_MEMORY, "needs a database shared by apps")
+    @unittest.skipIf(fcntl is None, "needs fcntl")
+    def test_shared_quiz_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = {
+                "SQLALCHEMY_DATABASE_URI": self.database_path,
+                "QUIZ_SHARED_INDEX": os.path.join(directory, "quiz-index"),
+                "QUIZ_SHARED_INDEX_POLL": 0,
+            }
+            first = create_app(config)
+            second = create_app(config)
+            first_index = first.extensions["question_index"]
+            second_index = second.extensions["question_index"]
+            self.assertEqual(first_index.version, second_index.version)
+            with second.app_context():
+                num_questions = Question.query.count()
+                self.assertEqual(len(second_index.candidates()),
+                                 num_questions)
+
+            first.test_client().post("/questions", json={
+                "question": "Which planet is closest to the sun?",
+                "answer": "Mercury",
+                "category": 1,
+                "difficulty": 0,
+            })
+            with second.app_context():
+                key = Question.query.order_by(Question.id.desc()).first().id
+                self.assertIn(key, second_index.candidates(1, 0))
+            first.test_client().delete(f"/questions/{key}")
+            with second.app_context():
+                self.assertNotIn(key, second_index.candidates())
+
+            res = second.test_client().post("/quizzes", json={
+                "previous_questions": [], "quiz_category": {"id": 1},
+            })
+            self.assertEqual(res.status_code, HTTPStatus.OK)
+            self.assertEqual(res.get_json()["question"]["category"], 1)
+
+    # while the file is being built the ids are read without waiting
+    @unittest.skipIf(TEST_IN_MEMORY, "needs a database shared by apps")
+    @unittest.skipIf(fcntl is None, "needs fcntl")
+    def test_shared_quiz_index_building(self):
+        from flaskr.shared_index import SharedQuestionIndex
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "quiz-index")
+            index = SharedQuestionIndex(path)
+            with self.app.app_context():
+                num_questions = Question.query.count()
+                # built by another process
+                with open(f"{path}.lock", "a") as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    self.assertEqual(len(index.candidates()), num_questions)
+                self.assertFalse(os.path.exists(path))
+
+                # built by another request of the process
+                index = SharedQuestionIndex(path)
+                with index._refresh_lock:
+                    self.assertEqual(len(index.candidates()), num_questions)
+                index._checked_at = 0.0
+                index.load()
+                self.assertTrue(os.path.exists(path))
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
@@ -14,6 +14,9 @@ class QuestionView extends Component {
       totalQuestions: 0,
       categories: {},
       currentCategory: null,
+      // the questions listed: all of them, a category or search results,
+      // the page numbers fetch more of the same
+      listing: {kind: 'all'},
     };
   }
 
@@ -41,7 +44,23 @@ class QuestionView extends Component {
   }
 
   selectPage(num) {
-    this.setState({page: num}, () => this.getQuestions());
+    this.setState({page: num}, () => this.fetchPage());
+  }
+
+  fetchPage() {
+    const listing = this.state.listing;
+    if (listing.kind === 'category') {
+      this.fetchCategory(listing.id);
+    } else if (listing.kind === 'search') {
+      this.fetchSearch(listing.searchTerm);
+    } else {
+      this.getQuestions();
+    }
+  }
+
+  showAll = () => {
+    this.setState({page: 1, listing: {kind: 'all'}},
+        () => this.getQuestions());
   }
 
   createPagination() {
@@ -61,8 +80,13 @@ class QuestionView extends Component {
   }
 
   getByCategory= (id) => {
+    this.setState({page: 1, listing: {kind: 'category', id: id}},
+        () => this.fetchCategory(id));
+  }
+
+  fetchCategory(id) {
     $.ajax({
-      url: `/categories/${id}/questions`, // TODO: update request URL
+      url: `/categories/${id}/questions?page=${this.state.page}`,
       type: 'GET',
       success: (result) => {
         this.setState({
@@ -79,13 +103,17 @@ class QuestionView extends Component {
   }
 
   submitSearch = (searchTerm) => {
-    const x = 5;
+    this.setState({page: 1, listing: {kind: 'search', searchTerm: searchTerm}},
+        () => this.fetchSearch(searchTerm));
+  }
+
+  fetchSearch(searchTerm) {
     $.ajax({
       url: `/questions/search`, // TODO: update request URL
       type: 'POST',
       dataType: 'json',
       contentType: 'application/json',
-      data: JSON.stringify({searchTerm: searchTerm}),
+      data: JSON.stringify({searchTerm: searchTerm, page: this.state.page}),
       xhrFields: {
         withCredentials: true,
       },
@@ -111,7 +139,7 @@ class QuestionView extends Component {
           url: `/questions/${id}`, // TODO: update request URL
           type: 'DELETE',
           success: (result) => {
-            this.getQuestions();
+            this.fetchPage();
           },
           error: (error) => {
             alert('Unable to load questions. Please try your request again');
@@ -126,9 +154,7 @@ class QuestionView extends Component {
     return (
       <div className="question-view">
         <div className="categories-list">
-          <h2 onClick={() => {
-            this.getQuestions();
-          }}>Categories</h2>
+          <h2 onClick={this.showAll}>Categories</h2>
           <ul>
             {Object.keys(this.state.categories).map((id ) => (
               <li key={id} onClick={() => {